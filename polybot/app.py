@@ -1,121 +1,236 @@
+import functools
 import json
 import os
+import sys
+import threading
+import time
 from loguru import logger
-import boto3
 import flask
-from botocore.exceptions import ClientError
 from flask import request
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from bot import ObjectDetectionBot
+import aws_clients
+from jobs import JobQueue
+from dedup import create_dedup_cache
+from result_cache import create_result_cache
 import getsecret
+from metrics import timed, ERRORS
 
 
+# every log line carries the trace id (the prediction id) of the job it belongs to, "-" outside of one
+logger.configure(
+    handlers=[{'sink': sys.stderr, 'format': '{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {extra[trace_id]} | {name}:{function}:{line} - {message}'}],
+    extra={'trace_id': '-'},
+)
 
 app = flask.Flask(__name__)
 
-TELEGRAM_TOKEN = getsecret.get_secret()
-# TODO load TELEGRAM_TOKEN value from Secret Manager
-def get_secret():
+def get_telegram_token():
+    """The first secret names the one holding TELEGRAM_TOKEN, both are cached by getsecret"""
+    secret_name = getsecret.get_secret()
+    secret_json_str = getsecret.get_secret(secret_name, region_name=os.environ['regionraoof'])
+    return json.loads(secret_json_str).get('TELEGRAM_TOKEN')
 
-    region_name = os.environ['regionraoof']
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=TELEGRAM_TOKEN
-        )
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
-
-    secret = get_secret_value_response['SecretString']
-    return secret
-
-
-secret_json_str = get_secret()
-if secret_json_str:
-    secret_dict = json.loads(secret_json_str)
-    TELEGRAM_TOKEN = secret_dict.get('TELEGRAM_TOKEN')
-else:
-    print("Failed to retrieve the secret")
 
 TELEGRAM_APP_URL = os.environ['TELEGRAM_APP_URL']
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_QUEUE_DEPTH = int(os.environ.get('JOB_QUEUE_DEPTH', 32))
+FILTER_WORKERS = int(os.environ.get('FILTER_WORKERS', os.cpu_count() or 1))
+ZERO_DISK = os.environ.get('ZERO_DISK', 'true').lower() == 'true'
+RESULTS_QUEUE_URL = os.environ.get('RESULTS_QUEUE_URL')
+PORT = int(os.environ.get('PORT', 8443))
+# lazy: serve right away and set up the bot in the background, /ready fails until it is done.
+# eager: set up the bot before serving, like the first versions did
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'lazy')
+
+# set by startup()
+TELEGRAM_TOKEN = None
+job_queue = None
+bot = None
+ready = threading.Event()
+
+# Telegram redelivers updates that were answered slowly, drop them before doing any work
+dedup_cache = create_dedup_cache(
+    backend=os.environ.get('DEDUP_BACKEND', 'memory'),
+    max_size=int(os.environ.get('DEDUP_MAX_SIZE', 10000)),
+    ttl=int(os.environ.get('DEDUP_TTL', 300)),
+    redis_url=os.environ.get('REDIS_URL'),
+)
+
+# filtered images and prediction summaries of photos seen before, the shared tier needs RESULT_CACHE_REDIS_URL
+result_cache = create_result_cache(
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+    ttl=int(os.environ.get('RESULT_CACHE_TTL', 3600)),
+    redis_url=os.environ.get('RESULT_CACHE_REDIS_URL'),
+)
+
+
+def enqueue_message(msg):
+    """Hands the message to the job queue, replies "busy" right away if the queue or the chat's share of it is full"""
+    if not job_queue.submit(bot.handle_message, msg, chat_id=msg['chat']['id'], lane=bot.lane(msg)):
+        logger.warning(f'Job queue saturated, rejecting message from chat {msg["chat"]["id"]}')
+        bot.send_text(msg['chat']['id'], 'The bot is busy right now, please try again later')
+
+
+def startup():
+    """Loads the token and sets up the job queue and the bot, retrying until it works, then marks the app ready"""
+    global TELEGRAM_TOKEN, job_queue, bot
+    started_at = time.monotonic()
+    delay = 1
+    while True:
+        try:
+            TELEGRAM_TOKEN = get_telegram_token()
+            if job_queue is None:
+                job_queue = JobQueue(max_workers=JOB_WORKERS, max_queue=JOB_QUEUE_DEPTH, filter_workers=FILTER_WORKERS)
+            bot = ObjectDetectionBot(TELEGRAM_TOKEN, TELEGRAM_APP_URL, job_queue=job_queue, zero_disk=ZERO_DISK,
+                                     result_cache=result_cache)
+            break
+        except Exception as e:
+            logger.exception(f'Startup failed, retrying in {delay}s: {e}')
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    if RESULTS_QUEUE_URL:
+        threading.Thread(target=drain_results_queue, name='results-queue', daemon=True).start()
+    ready.set()
+    logger.info(f'Ready after {time.monotonic() - started_at:.2f}s')
+
+    # the imaging modules are only needed by filter captions, import them now rather than on the first one
+    bot.warm_up()
+
+
+def when_ready(view):
+    """Answers 503 until startup() is done, Telegram and the load balancer retry later"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ready.is_set():
+            return 'Starting', 503
+        return view(*args, **kwargs)
+    return wrapper
 
 
 @app.route('/health_check', methods=['GET'])
 def health_checks():
+    """Liveness: the process is up and serving"""
     return 'Ok', 200
 
 
+@app.route('/ready', methods=['GET'])
+def readiness():
+    """Readiness: the bot is set up and can handle updates"""
+    return ('Ok', 200) if ready.is_set() else ('Starting', 503)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+
 @app.route('/', methods=['GET'])
 def index():
     return 'Ok'
 
 
-@app.route(f'/{TELEGRAM_TOKEN}/', methods=['POST'])
-def webhook():
+@app.route('/jobs/stats', methods=['GET'])
+@when_ready
+def job_stats():
+    return flask.jsonify({**job_queue.stats(), 'duplicates': dedup_cache.duplicates, 'result_cache': result_cache.stats()})
+
+
+# the token is only known once startup() has run, so the route matches any path and checks it
+@app.route('/<token>/', methods=['POST'])
+@when_ready
+def webhook(token):
+    if token != TELEGRAM_TOKEN:
+        return 'Not found', 404
     req = request.get_json()
-    bot.handle_message(req['message'])
+    if dedup_cache.is_duplicate(req):
+        logger.info(f'Dropping duplicate update {req.get("update_id")}')
+        return 'Ok'
+    enqueue_message(req['message'])
     return 'Ok'
 
 
+def send_prediction_results(result):
+    """Sends the class counts of a prediction result (chat_id, detections, content_hash) to the user"""
+    from detections import Detections  # numpy, kept off the startup path
+    text_results = Detections.from_item(result).summary_text()
+
+    if result.get('content_hash'):
+        result_cache.set(f"predict:{result['content_hash']}", text_results.encode())
+
+    bot.send_text(result['chat_id'], text_results)
+
+
+def drain_results_queue():
+    """Delivers the results the yolo5 workers couldn't post to /results, in batches of up to 10"""
+    sqs_client = aws_clients.get_client('sqs', region_name=os.environ['REGION_NAME'])
+    while True:
+        try:
+            response = sqs_client.receive_message(QueueUrl=RESULTS_QUEUE_URL, MaxNumberOfMessages=10, WaitTimeSeconds=20)
+            handled = []
+            for message in response.get('Messages', []):
+                try:
+                    send_prediction_results(json.loads(message['Body']))
+                    handled.append({'Id': str(len(handled)), 'ReceiptHandle': message['ReceiptHandle']})
+                except Exception as e:
+                    logger.error(f'Error delivering queued result {message["MessageId"]}: {e}')
+            if handled:
+                sqs_client.delete_message_batch(QueueUrl=RESULTS_QUEUE_URL, Entries=handled)
+        except Exception as e:
+            logger.error(f'Error draining the results queue: {e}')
+            time.sleep(5)
+
+
 @app.route(f'/results', methods=['POST'])
+@when_ready
 def results():
-    # TODO use the prediction_id to retrieve results from DynamoDB and send to the end-user
-    region_name = os.environ['regionraoof']
-    dynamodb = boto3.resource('dynamodb', region_name=region_name)
-    table = dynamodb.Table('raoof-DB')
+    body = flask.request.get_json(silent=True) or {}
+    prediction_id = flask.request.args.get('predictionId') or body.get('predictionId')
+    with logger.contextualize(trace_id=body.get('traceId') or prediction_id or '-'), timed('results'):
+        return handle_results(body, prediction_id)
 
+
+def handle_results(body, prediction_id):
     logger.info("Received request at /results endpoint")
     try:
-        prediction_id = flask.request.args.get('predictionId')
-        if not prediction_id:
-            prediction_id = flask.request.json.get('predictionId')
+
+        # the worker pushes the detections along with the notification, no DynamoDB read needed
+        if 'detections' in body or 'labels' in body:
+            send_prediction_results(body)
+            return 'Ok'
 
         if not prediction_id:
             return 'predictionId is required', 400
 
-        response = table.get_item(Key={'prediction_id': prediction_id})
+        region_name = os.environ['regionraoof']
+        dynamodb = aws_clients.get_resource('dynamodb', region_name=region_name)
+        table = dynamodb.Table('raoof-DB')
+
+        with timed('dynamodb_get'):
+            response = table.get_item(Key={'prediction_id': prediction_id})
         if 'Item' in response:
-            item = response['Item']
-            chat_id = item['chat_id']
-            labels = item['labels']
-
-            class_counts = {}
-            for label in labels:
-                class_name = label['class']
-                if class_name in class_counts:
-                    class_counts[class_name] += 1
-                else:
-                    class_counts[class_name] = 1
-
-            # text_results = f"Prediction results for image {item['original_img_path']}:\n"
-            text_results = ""
-            for class_name, count in class_counts.items():
-                text_results += f"{class_name}: {count}\n"
-
-            bot.send_text(chat_id, text_results)
+            send_prediction_results(response['Item'])
             return 'Ok'
         else:
             return 'No results found', 404
     except Exception as e:
-        print(f"Error processing results: {str(e)}")
+        logger.exception(f"Error processing results: {str(e)}")
+        ERRORS.labels('results').inc()
         return 'Error', 500
 
 
 @app.route(f'/loadTest/', methods=['POST'])
+@when_ready
 def load_test():
     req = request.get_json()
-    bot.handle_message(req['message'])
+    enqueue_message(req['message'])
     return 'Ok'
 
 
 if __name__ == "__main__":
-    bot = ObjectDetectionBot(TELEGRAM_TOKEN, TELEGRAM_APP_URL)
-    app.run(host='0.0.0.0', port=8443)
\ No newline at end of file
+    if STARTUP_MODE == 'eager':
+        startup()
+    else:
+        threading.Thread(target=startup, name='startup', daemon=True).start()
+    app.run(host='0.0.0.0', port=PORT)
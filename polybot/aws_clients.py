@@ -0,0 +1,70 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+
+# Keep-alive connections, a pool big enough for the worker threads, and adaptive retries with backoff
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50)),
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=60,
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+)
+
+_session = None
+_clients = {}
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def get_client(service_name, region_name=None):
+    """
+    Returns the shared client for (service, region), creating it on first use.
+    boto3 clients are thread safe, so one instance and its connection pool serve every thread.
+    """
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _get_session().client(service_name, region_name=region_name, config=CLIENT_CONFIG)
+                _clients[key] = client
+    return client
+
+
+def get_resource(service_name, region_name=None):
+    """
+    Returns a resource for (service, region). Resources are not thread safe,
+    so each thread gets its own, built on its own session.
+    """
+    resources = getattr(_local, 'resources', None)
+    if resources is None:
+        resources = _local.resources = {}
+
+    key = (service_name, region_name)
+    if key not in resources:
+        session = boto3.session.Session()
+        resources[key] = session.resource(service_name, region_name=region_name, config=CLIENT_CONFIG)
+    return resources[key]
+
+
+def reset():
+    """Drops every cached client, connections must not be shared with a forked child"""
+    global _session, _local, _lock
+    _session = None
+    _clients.clear()
+    _local = threading.local()
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset)
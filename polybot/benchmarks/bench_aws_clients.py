@@ -0,0 +1,62 @@
+"""
+Per-request cost of building boto3 clients versus reusing the shared ones from aws_clients.
+Client construction is local (no network), so this runs offline. Each new client also opens
+its own connection pool, so in production a fresh TLS handshake comes on top of these numbers.
+
+Run from the polybot directory:
+    python benchmarks/bench_aws_clients.py [--requests 50]
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import boto3
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import aws_clients  # noqa: E402
+
+
+def per_request(fn, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        fn()
+    return (time.perf_counter() - start) / requests * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    region = 'us-west-1'
+
+    # what the Predict branch and results() used to do on every request
+    scenarios = {
+        'predict (s3 + sqs)': (
+            lambda: (boto3.client('s3'), boto3.client('sqs', region_name=region)),
+            lambda: (aws_clients.get_client('s3'), aws_clients.get_client('sqs', region_name=region)),
+        ),
+        'results (dynamodb resource)': (
+            lambda: boto3.resource('dynamodb', region_name=region),
+            lambda: aws_clients.get_resource('dynamodb', region_name=region),
+        ),
+        'secret (secretsmanager)': (
+            lambda: boto3.session.Session().client('secretsmanager', region_name=region),
+            lambda: aws_clients.get_client('secretsmanager', region_name=region),
+        ),
+    }
+
+    print(f"{'path':>28} {'new client (ms)':>16} {'shared (ms)':>12} {'saved (ms)':>11}")
+    for name, (fresh, shared) in scenarios.items():
+        fresh_ms = per_request(fresh, args.requests)
+        shared()  # the first request builds the shared client, every later one reuses it
+        shared_ms = per_request(shared, args.requests)
+        print(f'{name:>28} {fresh_ms:>16.2f} {shared_ms:>12.4f} {fresh_ms - shared_ms:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
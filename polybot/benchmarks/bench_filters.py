@@ -0,0 +1,258 @@
+"""
+Offline benchmark and regression check of the imageproc filters and the caption chains.
+
+Runs on the committed synthetic photos in benchmarks/images (320p to 12 MP, RGB and grayscale):
+- times decoding, rgb2gray, Img.blur, contour, salt_n_pepper, encode and save_img, and every
+  caption chain through Pipeline, best of --repeat runs
+- records the peak memory of each of them with tracemalloc (allocations of this process only,
+  the parallel engine's workers aren't seen)
+- checks the pixels of every chain, with every engine (whole image, bands, parallel bands), against
+  the golden checksums in benchmarks/filters_golden.json, so a faster engine can't change the output
+- compares times and peak memory against benchmarks/filters_baseline.json, the times scaled by
+  how fast this machine runs a fixed numpy workload compared to the one that recorded the baseline
+
+Exits with status 1 if a checksum differs or a case is slower or bigger than the baseline by more
+than --tolerance. The calibration only evens out raw speed, for a strict check record a baseline
+on the machine that runs it with --update-baseline. --update-golden is only for an intended change
+of the output, and --generate rewrites the images (the checksums and the baseline then need updating).
+
+Run from the polybot directory:
+    python benchmarks/bench_filters.py [--images rgb-720p,gray-720p] [--repeat 5] [--output filters.json]
+"""
+import argparse
+import hashlib
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+from imageproc import Img, rgb2gray, display_pixels  # noqa: E402
+from pipeline import Pipeline, parse_caption  # noqa: E402
+
+IMAGES_DIR = BENCH_DIR / 'images'
+BASELINE = BENCH_DIR / 'filters_baseline.json'
+GOLDEN = BENCH_DIR / 'filters_golden.json'
+
+# name -> (width, height, mode)
+IMAGES = {
+    'rgb-320p': (568, 320, 'RGB'),
+    'rgb-720p': (1280, 720, 'RGB'),
+    'rgb-1080p': (1920, 1080, 'RGB'),
+    'rgb-12mp': (4000, 3000, 'RGB'),
+    'gray-720p': (1280, 720, 'L'),
+    'gray-1080p': (1920, 1080, 'L'),
+}
+
+CAPTIONS = ['Blur', 'Contour', 'Salt and pepper', 'Mix', 'Salt and pepper | Blur 8 | Contour',
+            'Gaussian 2', 'Sharpen', 'Sobel', 'Emboss']
+
+# the output of each of these must match the golden checksum of the first one of its group
+ENGINES = {
+    'whole': {},
+    'bands': {'max_band_bytes': 4 * 1024 * 1024},
+    'parallel': {'max_band_bytes': 4 * 1024 * 1024, 'workers': 2},
+    'color': {'color': True},
+}
+GROUPS = {'whole': 'gray', 'bands': 'gray', 'parallel': 'gray', 'color': 'color'}
+
+
+def synthetic_photo(width, height, mode, seed=0):
+    """Gradients, shapes with hard edges and a little sensor-like noise, so every filter has work to do"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    rgb = np.stack([x / width * 200, y / height * 200, (np.sin(x / 37) + np.cos(y / 53) + 2) * 50], axis=-1)
+    for _ in range(24):
+        cx, cy, r = rng.uniform(0, width), rng.uniform(0, height), rng.uniform(0.02, 0.15) * min(width, height)
+        inside = (x - cx) ** 2 + (y - cy) ** 2 < r ** 2
+        rgb[inside] = rng.uniform(0, 255, 3)
+    rgb += rng.normal(0, 4, rgb.shape)
+    image = Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8))
+    return image.convert(mode) if mode != 'RGB' else image
+
+
+def generate(names):
+    IMAGES_DIR.mkdir(exist_ok=True)
+    for name in names:
+        width, height, mode = IMAGES[name]
+        path = IMAGES_DIR / f'{name}.jpg'
+        synthetic_photo(width, height, mode).save(path, quality=85)
+        print(f'{path.relative_to(BENCH_DIR)}: {path.stat().st_size / 1024:.0f} KB')
+
+
+def checksum(data):
+    pixels = np.ascontiguousarray(display_pixels(data))
+    return hashlib.sha256(str(pixels.shape).encode() + pixels.tobytes()).hexdigest()
+
+
+def filtered_pixels(pipeline, data, name):
+    """Pipeline.run_bytes up to the encoding: the pixels that would be sent"""
+    if pipeline.uses_engine:
+        return Img.filtered(BytesIO(data), name, pipeline.engine, color=pipeline.color).data
+    return pipeline.apply(Img.from_bytes(data, name)).data
+
+
+def measure(fn, repeat):
+    """(best time, peak traced bytes), `fn` builds its own input so every run starts from the same state"""
+    times = []
+    for _ in range(repeat):
+        random.seed(0)
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    random.seed(0)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def calibrate(repeat=5):
+    """Best time of a fixed numpy workload, the baseline timings are scaled by how much faster this machine runs it"""
+    data = np.random.default_rng(0).random((1000, 2000))
+    return measure(lambda: np.floor(np.cumsum(data, axis=1) / 3), repeat)[0]
+
+
+def cases(name, data, workdir):
+    """case name -> function, each decodes its own copy so filters that work in place don't see another's output"""
+    path = workdir / f'{name}.jpg'
+    path.write_bytes(data)
+
+    def img():
+        return Img.from_bytes(data, path.name)
+
+    def op(method, *args):
+        def run():
+            getattr(img(), method)(*args)
+        return run
+
+    rgb = Img.filtered(BytesIO(data), path.name, lambda d: d).data
+
+    def save():
+        filtered = Img(path)
+        filtered.blur()
+        filtered.save_img()
+
+    result = {
+        'decode': img,
+        'rgb2gray': lambda: rgb2gray(rgb),
+        'blur': op('blur', 16),
+        'contour': op('contour'),
+        'salt_n_pepper': op('salt_n_pepper'),
+        'encode': lambda: img().encode(),
+        'blur+save_img': save,
+    }
+    for caption in CAPTIONS:
+        pipeline = parse_caption(caption)
+        result[f'chain:{caption}'] = lambda pipeline=pipeline: pipeline.run_bytes(data, path.name)
+    return result
+
+
+def check_pixels(name, data, golden, update):
+    """Returns the (image, caption, engine) whose pixels differ from the golden checksum"""
+    mismatches = []
+    for caption in CAPTIONS:
+        stages = parse_caption(caption).stages
+        for engine, options in ENGINES.items():
+            random.seed(0)  # salt and pepper draws its seed from `random`
+            digest = checksum(filtered_pixels(Pipeline(stages, **options), data, f'{name}.jpg'))
+            key = f'{name}|{caption}|{GROUPS[engine]}'
+            if update and key not in golden:
+                golden[key] = digest
+            if golden.get(key) != digest:
+                mismatches.append((name, caption, engine))
+    return mismatches
+
+
+def compare(results, baseline, speed, tolerance, min_seconds):
+    """
+    The cases slower or with a higher peak than the baseline by more than `tolerance`
+    :param speed: calibration time of this run over that of the baseline
+    """
+    regressed = []
+    for key, r in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        expected = old['seconds'] * speed
+        slower = r['seconds'] > expected * (1 + tolerance) and r['seconds'] - expected > min_seconds
+        bigger = r['peak_mb'] > old['peak_mb'] * (1 + tolerance) and r['peak_mb'] - old['peak_mb'] > 1
+        if slower or bigger:
+            regressed.append(key)
+            print(f"REGRESSED {key}: {r['seconds']:.4f}s {r['peak_mb']:.1f} MB, "
+                  f"baseline {expected:.4f}s {old['peak_mb']:.1f} MB")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', default=','.join(IMAGES), help='comma separated, out of: ' + ', '.join(IMAGES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed increase over the baseline')
+    parser.add_argument('--min-seconds', type=float, default=0.01,
+                        help='slowdowns smaller than this are noise, whatever the ratio')
+    parser.add_argument('--output', default='filters.json')
+    parser.add_argument('--no-checksums', action='store_true', help='only time, skip the golden output check')
+    parser.add_argument('--update-baseline', action='store_true', help='store these timings as the baseline')
+    parser.add_argument('--update-golden', action='store_true', help='store the checksums of outputs not in the golden file')
+    parser.add_argument('--generate', action='store_true', help='rewrite the synthetic images and exit')
+    args = parser.parse_args()
+
+    names = args.images.split(',')
+    if args.generate:
+        generate(names)
+        return
+
+    golden = json.loads(GOLDEN.read_text()) if GOLDEN.exists() else {}
+    calibration = calibrate()
+    results, mismatches = {}, []
+    with tempfile.TemporaryDirectory(prefix='polybot-filters-') as workdir:
+        print(f"{'image':>11} {'case':>42} {'seconds':>9} {'peak MB':>8}")
+        for name in names:
+            data = (IMAGES_DIR / f'{name}.jpg').read_bytes()
+            for case, fn in cases(name, data, Path(workdir)).items():
+                seconds, peak = measure(fn, args.repeat)
+                results[f'{name}|{case}'] = {'seconds': round(seconds, 5), 'peak_mb': round(peak / 2 ** 20, 2)}
+                print(f'{name:>11} {case:>42} {seconds:>9.4f} {peak / 2 ** 20:>8.1f}')
+            if not args.no_checksums:
+                mismatches += check_pixels(name, data, golden, args.update_golden)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeat': args.repeat,
+              'calibration_seconds': round(calibration, 5), 'results': results}
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f'\nResults saved to {args.output}')
+
+    if args.update_golden:
+        GOLDEN.write_text(json.dumps(golden, indent=2, sort_keys=True) + '\n')
+    if args.update_baseline:
+        # the other images keep their timings, which only stay comparable on the same machine
+        previous = json.loads(BASELINE.read_text())['results'] if BASELINE.exists() else {}
+        BASELINE.write_text(json.dumps({**report, 'results': {**previous, **results}}, indent=2) + '\n')
+        print(f'Baseline updated: {BASELINE.relative_to(BENCH_DIR.parent)}')
+
+    for name, caption, engine in mismatches:
+        print(f'CHECKSUM MISMATCH {name} "{caption}" with the {engine} engine')
+    regressed = []
+    if BASELINE.exists() and not args.update_baseline:
+        baseline = json.loads(BASELINE.read_text())
+        speed = calibration / baseline['calibration_seconds'] if baseline.get('calibration_seconds') else 1.0
+        print(f'This machine runs the calibration workload {1 / speed:.2f}x as fast as the baseline one')
+        regressed = compare(results, baseline['results'], speed, args.tolerance, args.min_seconds)
+    if mismatches or regressed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
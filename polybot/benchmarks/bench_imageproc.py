@@ -0,0 +1,97 @@
+"""
+Compares the numpy Img engine against the original list-of-lists implementation, which runs on
+every size up to --skip-reference-above (1280x960 by default, a realistic photo).
+
+Run from the polybot directory:
+    python benchmarks/bench_imageproc.py [--sizes 320x240,1280x960] [--blur-level 16]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from imageproc import Img  # noqa: E402
+
+
+class ListImg:
+    """The original pure-Python filters, kept as the reference implementation"""
+
+    def __init__(self, data):
+        self.data = data.tolist()
+
+    def blur(self, blur_level=16):
+        height = len(self.data)
+        width = len(self.data[0])
+        filter_sum = blur_level ** 2
+
+        result = []
+        for i in range(height - blur_level + 1):
+            row_result = []
+            for j in range(width - blur_level + 1):
+                sub_matrix = [row[j:j + blur_level] for row in self.data[i:i + blur_level]]
+                average = sum(sum(sub_row) for sub_row in sub_matrix) // filter_sum
+                row_result.append(average)
+            result.append(row_result)
+
+        self.data = result
+
+    def contour(self):
+        for i, row in enumerate(self.data):
+            res = []
+            for j in range(1, len(row)):
+                res.append(abs(row[j-1] - row[j]))
+
+            self.data[i] = res
+
+
+def make_img(data):
+    img = Img.__new__(Img)
+    img.path = Path('bench.jpg')
+    img.data = data.copy()
+    return img
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='160x120,320x240,1280x960')
+    parser.add_argument('--blur-level', type=int, default=16)
+    # 1280x960 is the size photos are filtered at (RESOLUTION_POLICY), its reference blur takes about 15 s
+    parser.add_argument('--skip-reference-above', type=int, default=1280 * 960,
+                        help='pixel count above which the slow reference is not run')
+    args = parser.parse_args()
+
+    filters = {
+        'blur': lambda img: img.blur(args.blur_level),
+        'contour': lambda img: img.contour(),
+    }
+
+    rng = np.random.default_rng(0)
+    print(f"{'size':>10} {'filter':>8} {'list (s)':>10} {'numpy (s)':>10} {'speedup':>8} {'max diff':>9}")
+    for size in args.sizes.split(','):
+        width, height = (int(v) for v in size.split('x'))
+        data = rng.random((height, width)) * 255
+
+        for name, apply in filters.items():
+            fast = make_img(data)
+            fast_time = timed(lambda: apply(fast))
+
+            if width * height <= args.skip_reference_above:
+                ref = ListImg(data)
+                ref_time = timed(lambda: apply(ref))
+                diff = np.max(np.abs(np.asarray(ref.data) - fast.data))
+                print(f'{size:>10} {name:>8} {ref_time:>10.3f} {fast_time:>10.4f} {ref_time / fast_time:>7.0f}x {diff:>9.3g}')
+            else:
+                print(f'{size:>10} {name:>8} {"-":>10} {fast_time:>10.4f} {"-":>8} {"-":>9}')
+
+
+if __name__ == '__main__':
+    main()
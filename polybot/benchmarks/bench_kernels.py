@@ -0,0 +1,66 @@
+"""
+Latency of the convolution kernels per method, and a check against the filter latency SLO.
+Exits with status 1 if the SLO filter (Gaussian sigma 8 by default) is over budget.
+
+Run from the polybot directory:
+    python benchmarks/bench_kernels.py [--size 1700x1200] [--slo 1.0]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from kernels import EMBOSS, SHARPEN, SOBEL_X, Gaussian, choose_method, convolve, gaussian_kernel, separate  # noqa: E402
+
+
+def best_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default='1700x1200', help='about 2 MP')
+    parser.add_argument('--slo', type=float, default=1.0, help='seconds allowed for --slo-sigma')
+    parser.add_argument('--slo-sigma', type=float, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split('x'))
+    data = np.random.default_rng(0).random((height, width)) * 255
+
+    kernels = {
+        'sharpen': SHARPEN,
+        'sobel x': SOBEL_X,
+        'emboss': EMBOSS,
+        **{f'gaussian {sigma:g}': gaussian_kernel(sigma) for sigma in (1, 2, 4, 8)},
+    }
+
+    print(f"{'kernel':>12} {'size':>6} {'chosen':>10} {'direct':>8} {'separable':>10} {'fft':>8}")
+    for name, kernel in kernels.items():
+        chosen = choose_method(data.shape, kernel)
+        row = [f'{name:>12}', f'{kernel.shape[0]:>6}', f'{chosen:>10}']
+        for method, width_ in (('direct', 8), ('separable', 10), ('fft', 8)):
+            if method == 'separable' and separate(kernel) is None:
+                row.append(f'{"-":>{width_}}')
+                continue
+            seconds = best_time(lambda: convolve(data, kernel, method=method), args.repeat)
+            row.append(f'{seconds:>{width_}.3f}')
+        print(' '.join(row))
+
+    # the filter a caption builds, from its 1D factors
+    seconds = best_time(lambda: Gaussian(args.slo_sigma)(data), args.repeat)
+    status = 'ok' if seconds <= args.slo else 'OVER SLO'
+    print(f'\ngaussian sigma {args.slo_sigma:g} on {args.size}: {seconds:.3f}s (SLO {args.slo:.3f}s) {status}')
+    sys.exit(0 if seconds <= args.slo else 1)
+
+
+if __name__ == '__main__':
+    main()
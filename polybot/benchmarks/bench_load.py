@@ -0,0 +1,221 @@
+"""
+Load test of polybot through /loadTest/, offline: Telegram, S3, SQS, Secrets Manager and DynamoDB
+are replaced by the in-memory stand-ins of benchmarks/standins.py.
+
+With --telegram-api the real Telegram client runs over HTTP against benchmarks/fake_telegram.py.
+
+Every path (a text message, each filter caption, Predict) runs in its own process, so the peak RSS
+is that of the path alone. Updates arrive open loop at --rate per second; a request is done when
+polybot sends its final reply (text and filters) or queues the prediction job (Predict).
+The results are saved as JSON; with --baseline the p95 latencies are compared against an earlier
+run and the script exits with status 1 if any path is slower than the baseline by more than
+--tolerance. The yolo5 side is covered by yolo5/benchmarks/bench_consumer.py.
+
+Run from the polybot directory:
+    python benchmarks/bench_load.py [--requests 50] [--rate 10] [--output load.json] [--baseline old.json]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+sys.path.insert(0, str(BENCH_DIR))
+
+CAPTIONS = ['Blur', 'Mix', 'Salt and pepper', 'Contour', 'Gaussian 2', 'Sharpen', 'Sobel', 'Emboss']
+PATHS = ['text', *CAPTIONS, 'Predict']
+TOKEN = '123456:bench-token'
+
+
+def make_update(path, i):
+    """A Telegram message for request i of `path`, each with its own chat so completions can be told apart"""
+    message = {'message_id': i, 'chat': {'id': i}}
+    if path == 'text':
+        message['text'] = f'hello {i}'
+    else:
+        # distinct photo ids, the result cache would otherwise answer every request after the first
+        message['photo'] = [{'file_id': f'file-{i}', 'file_unique_id': f'unique-{path}-{i}'}]
+        message['caption'] = path
+    return message
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'p50': round(float(p50), 4), 'p95': round(float(p95), 4), 'p99': round(float(p99), 4)}
+
+
+def run_path(args):
+    """Child process: runs one path against an in-process polybot and writes its results to args.child_output"""
+    import standins
+    from standins import Recorder, FakeTeleBot, FakeS3, FakeSQS, FakeSecretsManager, FakeDynamoDB
+    from fake_telegram import FakeTelegramServer
+
+    recorder = Recorder()
+    photo = standins.synthetic_jpeg(*(int(v) for v in args.size.split('x')))
+    telegram_server = None
+    if args.telegram_api:
+        # the real client over HTTP, against the local fake of the Bot API
+        def on_send(chat_id, text):
+            if standins.outcome_of(text):
+                recorder.finish(chat_id, standins.outcome_of(text))
+        telegram_server = FakeTelegramServer(photo=photo, on_send=on_send, latency=args.network_latency).start()
+        os.environ['TELEGRAM_API_URL'] = telegram_server.url
+    else:
+        FakeTeleBot.recorder = recorder
+        FakeTeleBot.photo = photo
+        FakeTeleBot.latency = args.network_latency
+
+    clients = {
+        's3': FakeS3(args.network_latency),
+        'sqs': FakeSQS(args.network_latency, recorder),
+        'secretsmanager': FakeSecretsManager(TOKEN),
+        'dynamodb': FakeDynamoDB(args.network_latency),
+    }
+
+    import telebot
+    import aws_clients
+    if telegram_server is None:
+        telebot.TeleBot = FakeTeleBot
+    aws_clients.get_client = lambda service_name, region_name=None: clients[service_name]
+    aws_clients.get_resource = lambda service_name, region_name=None: clients[service_name]
+
+    os.environ.update({
+        'regionraoof': 'us-west-1', 'REGION_NAME': 'us-west-1', 'TELEGRAM_APP_URL': 'https://bench.local',
+        'S3_BUCKET_NAME': 'bench-bucket', 'SQS_QUEUE_URL': 'bench-queue', 'ZERO_DISK': str(args.zero_disk).lower(),
+    })
+    # the bot reads its webhook certificate and writes downloaded photos relative to the working directory
+    workdir = tempfile.mkdtemp(prefix='polybot-bench-')
+    os.chdir(workdir)
+    Path('YOURPUBLIC.pem').touch()
+
+    import app
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    app.startup()
+    client = app.app.test_client()
+
+    # one warm-up request outside of the measurement, it starts the filter pool
+    client.post('/loadTest/', json={'message': make_update(args.path, -1)})
+    recorder.wait(1, args.timeout)
+
+    sent = {}
+    start = time.perf_counter()
+    for i in range(args.requests):
+        # open loop: updates arrive on schedule whether or not polybot keeps up
+        delay = start + i / args.rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        sent[i] = time.perf_counter()
+        client.post('/loadTest/', json={'message': make_update(args.path, i)})
+
+    completed = recorder.wait(args.requests + 1, args.timeout)
+    app.job_queue.shutdown()
+
+    finished = {chat_id: done for chat_id, done in recorder.finished.items() if chat_id in sent}
+    latencies = [done - sent[chat_id] for chat_id, (done, outcome) in finished.items() if outcome == 'ok']
+    outcomes = [outcome for _, outcome in finished.values()]
+    last = max((done for done, _ in finished.values()), default=start)
+
+    result = {
+        'path': args.path,
+        'requests': args.requests,
+        'ok': outcomes.count('ok'),
+        'rejected': outcomes.count('rejected'),
+        'errors': outcomes.count('error'),
+        'timed_out': args.requests - len(finished),
+        'completed': completed,
+        **percentiles(latencies),
+        'throughput': round(outcomes.count('ok') / (last - start), 3) if last > start else 0.0,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        # the filter pool, reaped by the shutdown above
+        'children_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+    if telegram_server is not None:
+        result.update(telegram_connections=telegram_server.connections, telegram_rate_limited=telegram_server.rate_limited)
+    Path(args.child_output).write_text(json.dumps(result))
+
+
+def compare(results, baseline, tolerance):
+    """Prints the p95 of each path next to the baseline's, returns the paths that regressed"""
+    previous = {r['path']: r for r in baseline['paths']}
+    regressed = []
+    print(f"\n{'path':>16} {'p95':>8} {'baseline':>9} {'change':>8}")
+    for r in results:
+        old = previous.get(r['path'])
+        if old is None or not old['p95'] or r['p95'] is None:
+            continue
+        change = r['p95'] / old['p95'] - 1
+        flag = '' if change <= tolerance else ' REGRESSED'
+        if flag:
+            regressed.append(r['path'])
+        print(f"{r['path']:>16} {r['p95']:>8.3f} {old['p95']:>9.3f} {change:>+8.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths', default=','.join(PATHS), help='comma separated, out of: ' + ', '.join(PATHS))
+    parser.add_argument('--requests', type=int, default=50, help='per path')
+    parser.add_argument('--rate', type=float, default=10, help='requests per second')
+    parser.add_argument('--size', default='640x480', help='size of the synthetic photo')
+    parser.add_argument('--network-latency', type=float, default=0.02, help='seconds per stand-in call')
+    parser.add_argument('--zero-disk', type=lambda v: v.lower() == 'true', default=True)
+    parser.add_argument('--telegram-api', action='store_true',
+                        help='run the real Telegram client against benchmarks/fake_telegram.py instead of a stand-in')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for a path to finish')
+    parser.add_argument('--output', default='load.json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare the p95 latencies against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 increase over the baseline')
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    parser.add_argument('--child-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.path is not None:
+        run_path(args)
+        return
+
+    results = []
+    print(f"{'path':>16} {'ok':>5} {'rej':>4} {'err':>4} {'p50':>7} {'p95':>7} {'p99':>7} {'req/s':>7} {'rss MB':>7}")
+    for path in args.paths.split(','):
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            command = [sys.executable, __file__, '--path', path, '--child-output', output.name,
+                       *(f'--{k.replace("_", "-")}={v}' for k, v in vars(args).items()
+                         if k in ('requests', 'rate', 'size', 'network_latency', 'zero_disk', 'timeout'))]
+            if args.telegram_api:
+                command.append('--telegram-api')
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, cwd=BENCH_DIR.parent)
+            r = json.loads(Path(output.name).read_text())
+        results.append(r)
+        fmt = lambda v: f'{v:>7.3f}' if v is not None else f'{"-":>7}'
+        print(f"{path:>16} {r['ok']:>5} {r['rejected']:>4} {r['errors']:>4} {fmt(r['p50'])} {fmt(r['p95'])} "
+              f"{fmt(r['p99'])} {r['throughput']:>7.2f} {r['peak_rss_mb']:>7.1f}")
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {k: getattr(args, k) for k in ('requests', 'rate', 'size', 'network_latency', 'zero_disk',
+                                                    'telegram_api')},
+        'paths': results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f'\nResults saved to {args.output}')
+
+    if args.baseline:
+        regressed = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Scaling of the parallel band engine with the number of worker processes.
+
+Run from the polybot directory:
+    python benchmarks/bench_parallel.py [--size 4000x3000] [--workers 1,2,4,8] [--caption "salt and pepper | blur"]
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from imageproc import filter_tiled  # noqa: E402
+from parallel import filter_parallel  # noqa: E402
+from pipeline import parse_caption  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default='4000x3000')
+    parser.add_argument('--workers', default='1,2,4,8')
+    parser.add_argument('--caption', default='salt and pepper | blur')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split('x'))
+    rgb = (np.random.default_rng(0).random((height, width, 3)) * 255).astype(np.uint8)
+    filters = parse_caption(args.caption).filters()
+
+    expected = filter_tiled(rgb, filters, 0)
+    baseline = None
+    print(f"{'workers':>8} {'best (s)':>9} {'speedup':>8} {'identical':>10}")
+    for workers in (int(w) for w in args.workers.split(',')):
+        filter_parallel(rgb[:64 * workers], filters, workers)  # start the pool outside the measurement
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = filter_parallel(rgb, filters, workers)
+            times.append(time.perf_counter() - start)
+
+        best = min(times)
+        baseline = baseline or best
+        print(f'{workers:>8} {best:>9.3f} {baseline / best:>7.2f}x {str(np.array_equal(result, expected)):>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Cold start of polybot: time from launching `python app.py` until the process is live
+(/health_check answers) and until it is ready (/ready answers 200, or /health_check for builds
+without a readiness endpoint). Secrets Manager and Telegram are stand-ins from
+benchmarks/standins.py with --network-latency per call, so this runs offline.
+
+By default Telegram already has the webhook of this deployment, which is the usual case for a
+restart or a rollout; --webhook-changed starts from a different webhook.
+
+Run from the polybot directory, --polybot-dir points at another checkout to measure an older build:
+    python benchmarks/bench_startup.py [--runs 5] [--network-latency 0.1] [--polybot-dir ../old/polybot]
+"""
+import argparse
+import os
+import runpy
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+TOKEN = 'bench-token'
+APP_URL = 'https://bench.local'
+
+
+def run_child(args):
+    """Child process: installs the stand-ins and runs app.py as __main__"""
+    sys.path.insert(0, str(BENCH_DIR))
+    sys.path.insert(0, args.polybot_dir)
+    from standins import FakeTeleBot, FakeSecretsManager
+
+    import telebot
+    import aws_clients
+    FakeTeleBot.latency = args.network_latency
+    if not args.webhook_changed:
+        FakeTeleBot.webhook_url = f'{APP_URL}:8443/{TOKEN}/'
+    telebot.TeleBot = FakeTeleBot
+    secrets = FakeSecretsManager(TOKEN, args.network_latency)
+    aws_clients.get_client = lambda service_name, region_name=None: secrets
+
+    os.chdir(args.polybot_dir)
+    runpy.run_path('app.py', run_name='__main__')
+
+
+def first_ok(url):
+    """Status of a GET, None while the server doesn't accept connections"""
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return None
+
+
+def measure(args):
+    """Seconds until live and until ready, for one cold start"""
+    env = {**os.environ, 'regionraoof': 'us-west-1', 'REGION_NAME': 'us-west-1', 'TELEGRAM_APP_URL': APP_URL,
+           'PORT': str(args.port)}
+    command = [sys.executable, __file__, '--child', '--polybot-dir', args.polybot_dir,
+               f'--network-latency={args.network_latency}']
+    if args.webhook_changed:
+        command.append('--webhook-changed')
+
+    base = f'http://127.0.0.1:{args.port}'
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    live = ready = None
+    try:
+        while ready is None and time.perf_counter() - start < args.timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f'app.py exited with status {process.returncode}')
+            if live is None and first_ok(f'{base}/health_check') == 200:
+                live = time.perf_counter() - start
+            if live is not None:
+                status = first_ok(f'{base}/ready')
+                if status == 200 or status == 404:
+                    ready = time.perf_counter() - start
+            time.sleep(0.005)
+    finally:
+        process.terminate()
+        process.wait()
+    return live, ready
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--network-latency', type=float, default=0.1, help='seconds per Secrets Manager/Telegram call')
+    parser.add_argument('--webhook-changed', action='store_true')
+    parser.add_argument('--polybot-dir', default=str(BENCH_DIR.parent))
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.polybot_dir = str(Path(args.polybot_dir).resolve())
+
+    if args.child:
+        run_child(args)
+        return
+
+    lives, readies = [], []
+    for _ in range(args.runs):
+        live, ready = measure(args)
+        lives.append(live)
+        readies.append(ready)
+        print(f'live {live:.3f}s  ready {ready:.3f}s')
+    print(f'\nmedian of {args.runs}: live {statistics.median(lives):.3f}s, ready {statistics.median(readies):.3f}s')
+
+
+if __name__ == '__main__':
+    main()
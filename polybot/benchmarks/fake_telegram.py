@@ -0,0 +1,159 @@
+"""
+A local fake of the Telegram Bot API, enough of it for polybot: getMe, getWebhookInfo, setWebhook,
+deleteWebhook, getFile, file downloads, sendMessage and sendPhoto. It speaks HTTP/1.1 keep-alive
+and enforces a per-chat rate limit by answering 429 with retry_after like Telegram does.
+
+Point polybot at it with TELEGRAM_API_URL=http://127.0.0.1:<port>, or run it on its own:
+    python benchmarks/fake_telegram.py [--port 8081] [--chat-rate 1] [--chat-burst 3]
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    """
+    :param photo: bytes served for every file download
+    :param on_send: (chat_id, text or caption) -> None, called for every message and photo accepted
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, photo=b'', on_send=None, chat_rate=1.0, chat_burst=3, latency=0.0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.photo = photo
+        self.on_send = on_send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.latency = latency
+        self.webhook = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        self.lock = threading.Lock()
+        self.buckets = {}  # chat id -> (tokens, updated at)
+        self.sent = 0
+        self.rate_limited = 0
+        self.connections = 0
+        self.message_id = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def allow(self, chat_id):
+        """Token bucket per chat, False means the message is answered with 429"""
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated_at = self.buckets.get(chat_id, (self.chat_burst, now))
+            tokens = min(self.chat_burst, tokens + (now - updated_at) * self.chat_rate)
+            if tokens < 1:
+                self.buckets[chat_id] = (tokens, now)
+                self.rate_limited += 1
+                return False
+            self.buckets[chat_id] = (tokens - 1, now)
+            self.sent += 1
+            self.message_id += 1
+            return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, content_type='application/json'):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _ok(self, result):
+        self._reply(200, {'ok': True, 'result': result})
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        # the request body (a certificate or a photo upload) isn't needed, but has to be read off the connection
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts[0] == 'file':
+            self._reply(200, self.server.photo, 'application/octet-stream')
+            return
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+
+        method = parts[1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        server = self.server
+
+        if method == 'getMe':
+            self._ok({'id': 1, 'is_bot': True, 'first_name': 'Polybot', 'username': 'polybot_fake_bot'})
+        elif method == 'getWebhookInfo':
+            self._ok(server.webhook)
+        elif method == 'setWebhook':
+            server.webhook.update(url=params.get('url', ''), has_custom_certificate=True)
+            self._ok(True)
+        elif method == 'deleteWebhook':
+            server.webhook.update(url='', has_custom_certificate=False)
+            self._ok(True)
+        elif method == 'getFile':
+            file_id = params.get('file_id', 'file')
+            self._ok({'file_id': file_id, 'file_unique_id': file_id, 'file_path': f'photos/{file_id}.jpg'})
+        elif method in ('sendMessage', 'sendPhoto'):
+            chat_id = int(params['chat_id'])
+            if not server.allow(chat_id):
+                self._reply(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                  'parameters': {'retry_after': 1}})
+                return
+            text = params.get('text') if method == 'sendMessage' else params.get('caption')
+            if server.on_send is not None:
+                server.on_send(chat_id, text)
+            message = {'message_id': server.message_id, 'date': int(time.time()),
+                       'chat': {'id': chat_id, 'type': 'private'}}
+            if method == 'sendMessage':
+                message['text'] = text
+            else:
+                message['photo'] = [{'file_id': 'sent', 'file_unique_id': 'sent', 'width': 1, 'height': 1}]
+                if text:
+                    message['caption'] = text
+            self._ok(message)
+        else:
+            self._reply(400, {'ok': False, 'error_code': 400, 'description': f'Bad Request: unknown method {method}'})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--chat-rate', type=float, default=1.0)
+    parser.add_argument('--chat-burst', type=int, default=3)
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(args.port, on_send=lambda chat_id, text: print(f'{chat_id}: {text}'),
+                                chat_rate=args.chat_rate, chat_burst=args.chat_burst)
+    print(f'Fake Telegram Bot API on {server.url}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+In-memory stand-ins for Telegram, S3, SQS, Secrets Manager and DynamoDB, so the load benchmarks
+run offline. Each call sleeps for a configurable latency to mimic the network round trip.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image
+
+
+def synthetic_jpeg(width, height, seed=0):
+    """A noisy gradient, compresses about as well as a photo"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // max(1, width - 1), y * 255 // max(1, height - 1), (x + y) % 256], axis=-1)
+    noise = rng.integers(0, 40, (height, width, 3))
+    buffer = BytesIO()
+    Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8)).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class Recorder:
+    """Completion time and outcome of every request, keyed by chat id"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = {}
+        self.all_done = threading.Condition(self.lock)
+
+    def finish(self, chat_id, outcome):
+        with self.lock:
+            if chat_id not in self.finished:
+                self.finished[chat_id] = (time.perf_counter(), outcome)
+                self.all_done.notify_all()
+
+    def wait(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while len(self.finished) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.all_done.wait(remaining)
+        return True
+
+
+def outcome_of(text):
+    """'ok', 'rejected' or 'error' if `text` (a message or a photo caption) ends a request, else None"""
+    if not text:
+        return None
+    if text.startswith('Your original message') or 'filter applied' in text:
+        return 'ok'
+    if 'busy' in text:
+        return 'rejected'
+    if 'failed' in text.lower() or text.startswith('Error'):
+        return 'error'
+    return None
+
+
+class FakeTeleBot:
+    """
+    Replaces telebot.TeleBot. Telegram's reply is the end of a text or filter request, so the
+    terminal messages are reported to the recorder.
+    """
+    recorder = None
+    photo = b''
+    latency = 0.0
+    # the webhook Telegram already has, as left by the previous deployment
+    webhook_url = ''
+
+    def __init__(self, token, *args, **kwargs):
+        self.token = token
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def remove_webhook(self):
+        self._call()
+
+    def set_webhook(self, url=None, *args, **kwargs):
+        self._call()
+        FakeTeleBot.webhook_url = url
+
+    def get_webhook_info(self):
+        self._call()
+        return SimpleNamespace(url=self.webhook_url, has_custom_certificate=bool(self.webhook_url))
+
+    def get_me(self):
+        self._call()
+        return SimpleNamespace(username='bench_bot')
+
+    def get_file(self, file_id):
+        self._call()
+        return SimpleNamespace(file_id=file_id, file_path=f'photos/{file_id}.jpg')
+
+    def download_file(self, file_path):
+        self._call()
+        return self.photo
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._call()
+        if outcome_of(text):
+            self.recorder.finish(chat_id, outcome_of(text))
+
+    def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        self._call()
+        if outcome_of(caption):
+            self.recorder.finish(chat_id, outcome_of(caption))
+
+
+class FakeS3:
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        time.sleep(self.latency)
+        self.objects[(bucket, key)] = fileobj.read()
+
+    def upload_file(self, filename, bucket, key, **kwargs):
+        time.sleep(self.latency)
+        with open(filename, 'rb') as f:
+            self.objects[(bucket, key)] = f.read()
+
+    def download_fileobj(self, bucket, key, fileobj, **kwargs):
+        time.sleep(self.latency)
+        fileobj.write(self.objects[(bucket, key)])
+
+
+class FakeSQS:
+    """A single in-memory queue; the Predict request of polybot ends when its job is sent"""
+
+    def __init__(self, latency=0.0, recorder=None):
+        self.latency = latency
+        self.recorder = recorder
+        self.messages = deque()
+        self.lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        time.sleep(self.latency)
+        message_id = str(uuid.uuid4())
+        with self.lock:
+            self.messages.append({'MessageId': message_id, 'ReceiptHandle': message_id, 'Body': MessageBody})
+        if self.recorder is not None:
+            self.recorder.finish(json.loads(MessageBody).get('chat_id'), 'ok')
+        return {'MessageId': message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            batch = [self.messages.popleft() for _ in range(min(MaxNumberOfMessages, len(self.messages)))]
+        if not batch and WaitTimeSeconds:
+            # short stand-in for a long poll, the benchmark shouldn't idle for 20s
+            time.sleep(min(WaitTimeSeconds, 0.05))
+        return {'Messages': batch} if batch else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        time.sleep(self.latency)
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        time.sleep(self.latency)
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+
+class FakeSecretsManager:
+
+    def __init__(self, token, latency=0.0):
+        self.token = token
+        self.latency = latency
+
+    def get_secret_value(self, SecretId):
+        time.sleep(self.latency)
+        return {'SecretString': json.dumps({'TELEGRAM_TOKEN': self.token})}
+
+
+class FakeTable:
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.items = {}
+
+    def get_item(self, Key):
+        time.sleep(self.latency)
+        item = self.items.get(Key['prediction_id'])
+        return {'Item': item} if item is not None else {}
+
+
+class FakeDynamoDB:
+    """Both the resource (Table().get_item) and the client (put_item) side"""
+
+    def __init__(self, latency=0.0):
+        self.table = FakeTable(latency)
+
+    def Table(self, name):
+        return self.table
+
+    def put_item(self, TableName, Item):
+        time.sleep(self.table.latency)
+        self.table.items[Item['prediction_id']['S']] = Item
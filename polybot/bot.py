@@ -1,35 +1,59 @@
 import json
 import uuid
-import telebot
 from loguru import logger
 import os
-import time
+from io import BytesIO
+from pathlib import Path
 from telebot.types import InputFile
-from imageproc import Img
-import boto3
+from result_cache import content_key
+from metrics import timed, FILTER_SECONDS, CACHE_REQUESTS, filter_label
+import aws_clients
+from telegram_client import TelegramClient
+from resolution import ResolutionPolicy
 
 
+INVALID_CAPTION_TEXT = ("Error invalid caption\n Available captions are :\n1) Blur\n2) Mix\n3) Salt and pepper\n4) Contour\n5) Predict\n"
+                        "6) Gaussian <sigma>\n7) Sharpen\n8) Sobel\n9) Emboss\n"
+                        "Filters can be chained with |, e.g. \"Salt and pepper | Blur 8 | Contour\"")
+
+
+# filters that cost about as much as a text reply, scheduled with them
+CHEAP_FILTERS = ('contour',)
 
 
 class Bot:
 
     def __init__(self, token, telegram_chat_url):
-        # create a new instance of the TeleBot class.
-        # all communication with Telegram servers are done using self.telegram_bot_client
-        self.telegram_bot_client = telebot.TeleBot(token)
+        # all communication with Telegram servers are done using self.telegram_bot_client,
+        # a TeleBot on a shared keep-alive session with per-chat rate limiting
+        self.telegram_bot_client = TelegramClient(token)
 
-        # remove any existing webhooks configured in Telegram servers
-        self.telegram_bot_client.remove_webhook()
-        time.sleep(0.5)
+        # set the webhook URL, unless Telegram already has it from a previous start
+        webhook_url = f'{telegram_chat_url}:8443/{token}/'
+        webhook = self.telegram_bot_client.get_webhook_info()
+        if webhook.url != webhook_url or not webhook.has_custom_certificate:
+            # set_webhook replaces any existing webhook
+            with open("YOURPUBLIC.pem") as certificate:
+                self.telegram_bot_client.set_webhook(url=webhook_url, certificate=certificate, timeout=60)
+            logger.info('Webhook set successfully')
+        else:
+            logger.info('Webhook already set')
 
-        # set the webhook URL
-        self.telegram_bot_client.set_webhook(url=f'{telegram_chat_url}:8443/{token}/', certificate=open("YOURPUBLIC.pem"), timeout=60)
-        print("Webhook set successfully.")
+    def send_text(self, chat_id, text):
+        with timed('telegram_send'):
+            self.telegram_bot_client.send_message(chat_id, text)
 
-        logger.info(f'Telegram Bot information\n\n{self.telegram_bot_client.get_me()}')
+    def send_text_async(self, chat_id, text):
+        """Sends the text in the background, returns a Future"""
+        return self.telegram_bot_client.executor.submit(self.send_text, chat_id, text)
 
-    def send_text(self, chat_id, text):
-        self.telegram_bot_client.send_message(chat_id, text)
+    @staticmethod
+    def wait_for(future):
+        """Waits for a background send, a status message that failed isn't worth failing the request"""
+        try:
+            future.result()
+        except Exception as e:
+            logger.warning(f'Background send failed: {e}')
 
     def send_text_with_quote(self, chat_id, text, quoted_msg_id):
         self.telegram_bot_client.send_message(chat_id, text, reply_to_message_id=quoted_msg_id)
@@ -37,34 +61,63 @@ class Bot:
     def is_current_msg_photo(self, msg):
         return 'photo' in msg
 
+    def fetch_user_photo(self, msg, photo_size=None):
+        """
+        Downloads the photo that sent to the Bot into memory
+        :param photo_size: which of the message's PhotoSizes, the largest by default
+        :return: (Telegram file path, image bytes)
+        """
+        if not self.is_current_msg_photo(msg):
+            raise RuntimeError(f'Message content of type \'photo\' expected')
+
+        photo_size = photo_size or msg['photo'][-1]
+        with timed('telegram_download'):
+            file_info = self.telegram_bot_client.get_file(photo_size['file_id'])
+            data = self.telegram_bot_client.download_file(file_info.file_path)
+        return file_info.file_path, data
+
     def download_user_photo(self, msg):
         """
         Downloads the photos that sent to the Bot to `photos` directory (should be existed)
         :return:
         """
-        if not self.is_current_msg_photo(msg):
-            raise RuntimeError(f'Message content of type \'photo\' expected')
+        file_path, data = self.fetch_user_photo(msg)
+        return self.save_photo(file_path, data)
 
-        file_info = self.telegram_bot_client.get_file(msg['photo'][-1]['file_id'])
-        data = self.telegram_bot_client.download_file(file_info.file_path)
-        folder_name = file_info.file_path.split('/')[0]
+    @staticmethod
+    def save_photo(file_path, data):
+        folder_name = file_path.split('/')[0]
 
         if not os.path.exists(folder_name):
             os.makedirs(folder_name)
 
-        with open(file_info.file_path, 'wb') as photo:
+        with open(file_path, 'wb') as photo:
             photo.write(data)
 
-        return file_info.file_path
+        return file_path
 
-    def send_photo(self, chat_id, img_path):
+    def send_photo(self, chat_id, img_path, caption=None):
         if not os.path.exists(img_path):
             raise RuntimeError("Image path doesn't exist")
 
-        self.telegram_bot_client.send_photo(
-            chat_id,
-            InputFile(img_path)
-        )
+        with timed('telegram_send'):
+            self.telegram_bot_client.send_photo(
+                chat_id,
+                InputFile(img_path),
+                caption=caption
+            )
+
+    def send_photo_bytes(self, chat_id, data, file_name, caption=None):
+        with timed('telegram_send'):
+            self.telegram_bot_client.send_photo(
+                chat_id,
+                InputFile(BytesIO(data), file_name=file_name),
+                caption=caption
+            )
+
+    def warm_up(self):
+        """Imports the filter pipeline (numpy, matplotlib, Pillow) ahead of the first filter caption"""
+        import pipeline  # noqa: F401
 
     def handle_message(self, msg):
         """Bot Main message handler"""
@@ -74,6 +127,156 @@ class Bot:
 
 
 class ObjectDetectionBot(Bot):
+
+    def __init__(self, token, telegram_chat_url, job_queue=None, zero_disk=True, result_cache=None, resolution=None):
+        super().__init__(token, telegram_chat_url)
+        # the resolution each caption works at, see resolution.py
+        self.resolution = resolution or ResolutionPolicy()
+        # answers repeated photos from previous results, see result_cache.py
+        self.result_cache = result_cache
+        # when set, filters run in the job queue's process pool instead of the calling thread
+        self.job_queue = job_queue
+        # keep photos in memory from Telegram download to S3/Telegram upload, nothing is written to `photos/`
+        self.zero_disk = zero_disk
+
+    def fetch_scaled_photo(self, msg, operation):
+        """
+        Downloads the photo at the resolution the policy sets for `operation`: the smallest size
+        Telegram has that is large enough, downscaled locally if still larger than needed.
+        The photo is written to `photos/` unless zero_disk is set.
+        :return: (Telegram file path, image bytes, scale factor back to the largest size)
+        """
+        photo_size, target = self.resolution.choose(msg['photo'], operation)
+        file_path, data = self.fetch_user_photo(msg, photo_size)
+        with timed('downscale'):
+            data, scale = self.resolution.fit(data, file_path, photo_size, target, msg['photo'][-1])
+        if not self.zero_disk:
+            self.save_photo(file_path, data)
+        return file_path, data, scale
+
+    def run_pipeline(self, pipeline, img_path):
+        with timed('filter'), FILTER_SECONDS.labels(filter_label(pipeline)).time():
+            if self.job_queue is None:
+                return pipeline.run(img_path)
+            return self.job_queue.run_filter(pipeline, img_path)
+
+    def run_pipeline_bytes(self, pipeline, data, name):
+        with timed('filter'), FILTER_SECONDS.labels(filter_label(pipeline)).time():
+            if self.job_queue is None:
+                return pipeline.run_bytes(data, name)
+            return self.job_queue.run_filter_bytes(pipeline, data, name)
+
+    def apply_filter(self, msg, pipeline, caption=None, after=None):
+        """
+        Downloads the photo, runs the filter pipeline on it and sends the result back with `caption`.
+        :param after: Future of a status message that must reach the chat before the photo
+        """
+        photo_key = content_key(msg)
+        cache_key = f'filter:{pipeline}:{photo_key}'
+        if self.result_cache is not None and photo_key:
+            cached = self.result_cache.get(cache_key)
+            CACHE_REQUESTS.labels('filter', 'miss' if cached is None else 'hit').inc()
+            if cached is not None:
+                logger.info(f'Filter result cache hit for {cache_key}')
+                if after is not None:
+                    self.wait_for(after)
+                self.send_photo_bytes(msg["chat"]["id"], cached, 'filtered.jpg', caption)
+                return
+
+        img_path, data, _ = self.fetch_scaled_photo(msg, str(pipeline))
+        if self.zero_disk:
+            filtered = self.run_pipeline_bytes(pipeline, data, img_path)
+            if after is not None:
+                self.wait_for(after)
+            self.send_photo_bytes(msg["chat"]["id"], filtered, Path(img_path).name, caption)
+        else:
+            new_path = self.run_pipeline(pipeline, img_path)
+            if after is not None:
+                self.wait_for(after)
+            self.send_photo(msg["chat"]["id"], new_path, caption)
+            if self.result_cache is not None and photo_key:
+                with open(new_path, 'rb') as f:
+                    filtered = f.read()
+
+        if self.result_cache is not None and photo_key:
+            self.result_cache.set(cache_key, filtered)
+
+    def request_prediction(self, msg):
+        """Uploads the photo to S3 and queues a prediction job for the yolo5 workers"""
+        photo_key = content_key(msg)
+        if self.result_cache is not None and photo_key:
+            cached = self.result_cache.get(f'predict:{photo_key}')
+            CACHE_REQUESTS.labels('predict', 'miss' if cached is None else 'hit').inc()
+            if cached is not None:
+                logger.info(f'Prediction result cache hit for {photo_key}')
+                self.send_text(msg['chat']['id'], cached.decode())
+                return
+
+        # the prediction id is the trace id of the job, from here to the worker and back to /results
+        prediction_id = str(uuid.uuid4())
+        with logger.contextualize(trace_id=prediction_id):
+            # YOLO resizes to 640 itself, a full resolution upload would only cost bytes and time
+            img_path, data, scale = self.fetch_scaled_photo(msg, 'predict')
+            # goes out while the photo is uploaded and the job queued
+            processing = self.send_text_async(msg['chat']['id'], "Your image is being processed. Please wait...")
+            logger.info(f'Photo downloaded to: {img_path}')
+
+            # Split photo name
+            photo_s3_name = img_path.split("/")
+
+            # Get the bucket name from the environment variable
+            images_bucket = os.environ['S3_BUCKET_NAME']
+            sqs_queue_url = os.environ['SQS_QUEUE_URL']
+            region_name = os.environ['REGION_NAME']
+            # Upload the image to S3
+            s3_client = aws_clients.get_client('s3')
+            with timed('s3_upload'):
+                s3_client.upload_fileobj(BytesIO(data), images_bucket, photo_s3_name[-1])
+
+            # Prepare the data to be sent to SQS
+            json_data = {
+                'imgName': img_path,
+                'chat_id': msg['chat']['id'],
+                'prediction_id': prediction_id,
+                # echoed back in the results so the summary can be cached for this photo
+                'content_hash': photo_key,
+                # the boxes are relative to the uploaded image, this maps them back to the photo the user sent
+                'scale': scale,
+                'original_width': msg['photo'][-1].get('width'),
+                'original_height': msg['photo'][-1].get('height'),
+            }
+
+            try:
+                # Send job to queue
+                sqs = aws_clients.get_client('sqs', region_name=region_name)
+                with timed('sqs_send'):
+                    sqs.send_message(
+                        QueueUrl=sqs_queue_url,
+                        MessageBody=json.dumps(json_data)
+                    )
+                logger.info('Prediction job sent to queue')
+            except Exception as e:
+                logger.error(f'Error: {str(e)}')
+                self.wait_for(processing)
+                self.send_text(msg['chat']['id'], 'Failed to process the image. Please try again later.')
+            else:
+                self.wait_for(processing)
+
+    @staticmethod
+    def lane(msg):
+        """
+        Scheduler lane of the message: text replies and cheap filters ("fast") go ahead of the other
+        filters ("filter"), which go ahead of Predict ("predict")
+        """
+        caption = msg.get('caption')
+        if 'text' in msg or not caption:
+            return 'fast'
+        if caption == 'Predict':
+            return 'predict'
+        # parsed properly by the job, a rough look is enough here and keeps the imaging modules out of the webhook
+        stages = [segment.strip().lower() for segment in caption.split('|')]
+        return 'fast' if all(stage.startswith(CHEAP_FILTERS) for stage in stages) else 'filter'
+
     def handle_message(self, msg):
         """Bot Main message handler"""
         # logger.info(f'Incoming message: {msg}')
@@ -83,78 +286,22 @@ class ObjectDetectionBot(Bot):
             # if there is checkbox caption
             if "caption" in msg:
                 try:
-                    img_path = self.download_user_photo(msg)
-                    if msg["caption"] == "Blur":
-                        # Send message to telegram bot
-                        self.send_text(msg['chat']['id'], "Blur filter in progress")
-                        new_img = Img(img_path)
-                        new_img.blur()
-                        new_path = new_img.save_img()
-                        self.send_photo(msg["chat"]["id"], new_path)
-                        self.send_text(msg['chat']['id'], "Blur filter applied")
-                    elif msg["caption"] == "Contour":
-                        self.send_text(msg['chat']['id'], "Contour filter in progress")
-                        new_img = Img(img_path)
-                        new_img.contour()
-                        new_path = new_img.save_img()
-                        self.send_photo(msg["chat"]["id"], new_path)
-                        self.send_text(msg['chat']['id'], "Contour filter applied")
-                    elif msg["caption"] == "Salt and pepper":  # concat, segment
-                        self.send_text(msg['chat']['id'], "Salt and pepper filter in progress")
-                        new_img = Img(img_path)
-                        new_img.salt_n_pepper()
-                        new_path = new_img.save_img()
-                        self.send_photo(msg["chat"]["id"], new_path)
-                        self.send_text(msg['chat']['id'], "Salt and pepper filter applied")
-                    elif msg["caption"] == "Mix":
-                        self.send_text(msg['chat']['id'], "Mix filter in progress")
-                        new_img = Img(img_path)
-                        new_img.salt_n_pepper()
-                        new_path = new_img.save_img()
-
-                        new_img2 = Img(new_path)
-                        new_img2.blur()
-                        new_path = new_img2.save_img()
-
-                        self.send_photo(msg["chat"]["id"], new_path)
-                        self.send_text(msg['chat']['id'], "mix filter applied")
-
-                    elif msg["caption"] == "Predict":
-                        self.send_text(msg['chat']['id'], "Your image is being processed. Please wait...")
-                        logger.info(f'Photo downloaded to: {img_path}')
-
-                        # Split photo name
-                        photo_s3_name = img_path.split("/")
-
-                        # Get the bucket name from the environment variable
-                        images_bucket = os.environ['S3_BUCKET_NAME']
-                        sqs_queue_url = os.environ['SQS_QUEUE_URL']
-                        region_name = os.environ['REGION_NAME']
-                        # Upload the image to S3
-                        s3_client = boto3.client('s3')
-                        s3_client.upload_file(img_path, images_bucket, photo_s3_name[-1])
-
-                        # Prepare the data to be sent to SQS
-                        prediction_id = str(uuid.uuid4())
-                        json_data = {
-                            'imgName': img_path,
-                            'chat_id': msg['chat']['id'],
-                            'prediction_id': prediction_id
-                        }
-
+                    if msg["caption"] != "Predict":
+                        from pipeline import parse_caption
                         try:
-                            # Send job to queue
-                            sqs = boto3.client('sqs', region_name=region_name)
-                            response = sqs.send_message(
-                                QueueUrl=sqs_queue_url,
-                                MessageBody=json.dumps(json_data)
-                            )
-                            # self.send_text(msg['chat']['id'], f"Job sent to queue. PredictionId: {prediction_id}")
-                        except Exception as e:
-                            logger.error(f'Error: {str(e)}')
-                            self.send_text(msg.chat.id, 'Failed to process the image. Please try again later.')
+                            pipeline = parse_caption(msg["caption"])
+                        except ValueError as e:
+                            logger.info(f"Invalid caption: {e}")
+                            self.send_text(msg['chat']['id'], INVALID_CAPTION_TEXT)
+                            return
+
+                        # the status message goes out while the photo is downloaded and filtered,
+                        # "applied" is the caption of the filtered photo instead of a message of its own
+                        progress = self.send_text_async(msg['chat']['id'], f"{msg['caption']} filter in progress")
+                        self.apply_filter(msg, pipeline, caption=f"{msg['caption']} filter applied", after=progress)
+
                     else:
-                        self.send_text(msg['chat']['id'],"Error invalid caption\n Available captions are :\n1) Blur\n2) Mix\n3) Salt and pepper\n4) Contour\n5) Predict")
+                        self.request_prediction(msg)
                 except Exception as e:
                     logger.info(f"Error {e}")
                     self.send_text(msg['chat']['id'], f'failed - try again later')
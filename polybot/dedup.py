@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    """In-process TTL + LRU set of keys"""
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        """Adds key, returns False if it was already present and not expired"""
+        now = time.monotonic()
+        with self.lock:
+            expires_at = self.entries.get(key)
+            if expires_at is not None and expires_at > now:
+                self.entries.move_to_end(key)
+                return False
+
+            self.entries[key] = now + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return True
+
+
+class RedisBackend:
+    """Key set shared between pods through redis, expiry is handled by redis itself"""
+
+    def __init__(self, url, ttl=300, prefix='polybot:dedup:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def add(self, key):
+        return bool(self.client.set(self.prefix + key, 1, nx=True, ex=self.ttl))
+
+
+class DedupCache:
+    """Drops Telegram updates that were already received, by update_id and by (chat_id, message_id)"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.duplicates = 0
+
+    @staticmethod
+    def keys(update):
+        keys = []
+        if 'update_id' in update:
+            keys.append(f'update:{update["update_id"]}')
+        msg = update.get('message')
+        if msg and 'message_id' in msg:
+            keys.append(f'message:{msg["chat"]["id"]}:{msg["message_id"]}')
+        return keys
+
+    def is_duplicate(self, update):
+        # evaluate every key so both get recorded, even if the first one was already known
+        added = [self.backend.add(key) for key in self.keys(update)]
+        if added and not all(added):
+            self.duplicates += 1
+            return True
+        return False
+
+
+def create_dedup_cache(backend='memory', max_size=10000, ttl=300, redis_url=None):
+    if backend == 'redis':
+        return DedupCache(RedisBackend(redis_url, ttl=ttl))
+    if backend == 'memory':
+        return DedupCache(MemoryBackend(max_size=max_size, ttl=ttl))
+    raise ValueError(f'Unknown dedup backend: {backend}')
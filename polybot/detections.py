@@ -0,0 +1,118 @@
+import base64
+import numpy as np
+
+# the same module is in polybot/ and yolo5/, keep them identical, both sides read what the other writes
+
+
+class Detections:
+    """
+    The detections of one image as three parallel arrays: class ids into `names`, (cx, cy, width,
+    height) boxes relative to the image size, and confidences.
+
+    Serialized as a comma-joined string of the class names, one per box, and the boxes and
+    confidences as little-endian float32 arrays: raw bytes in DynamoDB (to_item/from_item) and
+    base64 in JSON (to_json/from_json).
+    """
+    __slots__ = ('class_ids', 'boxes', 'confidences', 'names')
+
+    def __init__(self, class_ids, boxes, confidences, names):
+        self.class_ids = np.asarray(class_ids, dtype=np.intp).reshape(-1)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.confidences = np.asarray(confidences, dtype=np.float32).reshape(-1)
+        self.names = names
+
+    @classmethod
+    def from_model(cls, det, image_shape, names):
+        """
+        From the (n, 6) x1, y1, x2, y2, confidence, class id output of the model, in pixels.
+        A CPU tensor or array is read in place, the only copies are the converted columns.
+        """
+        det = det.cpu().numpy() if hasattr(det, 'cpu') else np.asarray(det)
+        height, width = image_shape[:2]
+        x1, y1, x2, y2 = det[:, 0], det[:, 1], det[:, 2], det[:, 3]
+        boxes = np.stack([(x1 + x2) / (2 * width), (y1 + y2) / (2 * height), (x2 - x1) / width, (y2 - y1) / height],
+                         axis=1)
+        if isinstance(names, dict):
+            names = [names[i] for i in range(len(names))]
+        return cls(det[:, 5].astype(np.intp), boxes, det[:, 4], names)
+
+    @classmethod
+    def from_classes(cls, classes, boxes=b'', confidences=b''):
+        """From the serialized fields, class ids index the distinct names in order of appearance"""
+        boxes, confidences = bytes(boxes), bytes(confidences)
+        per_box = classes.split(',') if classes else []
+        names = list(dict.fromkeys(per_box))
+        index = {name: i for i, name in enumerate(names)}
+        class_ids = np.fromiter((index[name] for name in per_box), dtype=np.intp, count=len(per_box))
+        boxes = np.frombuffer(boxes, dtype='<f4').reshape(-1, 4) if boxes else np.zeros((len(per_box), 4))
+        confidences = np.frombuffer(confidences, dtype='<f4') if confidences else np.ones(len(per_box))
+        return cls(class_ids, boxes, confidences, names)
+
+    @classmethod
+    def from_labels(cls, labels):
+        """From the older list of {'class', 'cx', 'cy', 'width', 'height'} dicts"""
+        boxes = np.array([[float(label.get(k, 0)) for k in ('cx', 'cy', 'width', 'height')] for label in labels],
+                         dtype='<f4')
+        return cls.from_classes(','.join(label['class'] for label in labels), boxes.tobytes())
+
+    @classmethod
+    def from_item(cls, item):
+        """From a DynamoDB item or a results payload, whichever of the encodings it carries"""
+        if 'detections' in item:
+            return cls.from_json(item['detections'])
+        if 'labels' in item:
+            return cls.from_labels(item['labels'])
+        return cls.from_classes(item.get('classes', ''), item.get('boxes', b''), item.get('confidences', b''))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls.from_classes(data['classes'], base64.b64decode(data['boxes']), base64.b64decode(data['confidences']))
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    def __repr__(self):
+        return f'Detections({self.counts()})'
+
+    @property
+    def classes(self):
+        """Class name of every box, comma joined"""
+        names = np.asarray(self.names, dtype=object)
+        return ','.join(names[self.class_ids]) if len(self) else ''
+
+    def counts(self):
+        """{class name: number of boxes} in class id order"""
+        counts = np.bincount(self.class_ids, minlength=len(self.names))
+        return {self.names[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+    def summary_text(self):
+        """The "<class>: <count>" lines sent to the user"""
+        return ''.join(f'{name}: {count}\n' for name, count in self.counts().items())
+
+    def to_pixels(self, width, height):
+        """(n, 4) x1, y1, x2, y2 boxes in pixels of a `width` x `height` image, e.g. the original photo"""
+        cx, cy, w, h = (self.boxes * np.array([width, height, width, height], dtype=np.float32)).T
+        return np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+
+    def to_item(self):
+        """The attributes stored in DynamoDB, boxes and confidences as raw bytes"""
+        return {
+            'classes': self.classes,
+            'boxes': self.boxes.astype('<f4', copy=False).tobytes(),
+            'confidences': self.confidences.astype('<f4', copy=False).tobytes(),
+        }
+
+    def to_json(self):
+        """JSON-safe form, the arrays base64 encoded"""
+        item = self.to_item()
+        return {
+            'classes': item['classes'],
+            'boxes': base64.b64encode(item['boxes']).decode(),
+            'confidences': base64.b64encode(item['confidences']).decode(),
+        }
+
+    def to_labels(self):
+        """The older list of dicts, for logs and readers that still expect it"""
+        names = self.classes.split(',') if len(self) else []
+        return [{'class': name, 'cx': float(cx), 'cy': float(cy), 'width': float(w), 'height': float(h)}
+                for name, (cx, cy, w, h) in zip(names, self.boxes.tolist())]
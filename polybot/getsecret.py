@@ -1,29 +1,45 @@
-import boto3
+import os
+import threading
+import time
+import aws_clients
 from botocore.exceptions import ClientError
 
-
-def get_secret():
-
-    secret_name = "raoof-secret"
-    region_name = "us-west-1"
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
-
-    return get_secret_value_response['SecretString']
-
-    # Your code goes here.
-
+# seconds a secret is served from memory before it is read again from Secrets Manager
+SECRET_TTL = int(os.environ.get('SECRET_TTL', 3600))
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_secret(secret_name="raoof-secret", region_name="us-west-1", ttl=SECRET_TTL):
+    """
+    Returns the SecretString of `secret_name`, cached for `ttl` seconds. If a refresh fails
+    the last known value is kept, so a Secrets Manager outage doesn't take the bot down.
+    """
+    key = (secret_name, region_name)
+    cached = _cache.get(key)
+    if cached is not None and time.monotonic() < cached[1]:
+        return cached[0]
+
+    with _lock:
+        cached = _cache.get(key)
+        if cached is not None and time.monotonic() < cached[1]:
+            return cached[0]
+
+        # Shared Secrets Manager client
+        client = aws_clients.get_client('secretsmanager', region_name=region_name)
+
+        try:
+            get_secret_value_response = client.get_secret_value(
+                SecretId=secret_name
+            )
+        except ClientError as e:
+            # For a list of exceptions thrown, see
+            # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
+            if cached is not None:
+                return cached[0]
+            raise e
+
+        secret = get_secret_value_response['SecretString']
+        _cache[key] = (secret, time.monotonic() + ttl)
+        return secret
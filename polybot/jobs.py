@@ -0,0 +1,253 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+from metrics import JOB_QUEUE_DEPTH, JOBS_REJECTED, LANE_DEPTH, LANE_WAIT_SECONDS
+
+
+def _parse_weights(text):
+    return {lane.strip(): int(weight) for lane, weight in (item.split('=') for item in text.split(','))}
+
+
+# lanes in priority order, with the share of dispatches each gets while they all have work
+LANE_WEIGHTS = _parse_weights(os.environ.get('SCHEDULER_LANE_WEIGHTS', 'fast=8,filter=3,predict=1'))
+# jobs of one chat that may run at the same time, and wait in the queue
+MAX_CHAT_RUNNING = int(os.environ.get('SCHEDULER_MAX_CHAT_RUNNING', 2))
+MAX_CHAT_QUEUED = int(os.environ.get('SCHEDULER_MAX_CHAT_QUEUED', 16))
+
+
+class TimingStats:
+    """Running count/total/max of a duration, in seconds"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+        }
+
+
+class Job:
+    __slots__ = ('fn', 'args', 'chat_id', 'lane', 'enqueued_at')
+
+    def __init__(self, fn, args, chat_id, lane):
+        self.fn = fn
+        self.args = args
+        self.chat_id = chat_id
+        self.lane = lane
+        self.enqueued_at = time.monotonic()
+
+
+class FairScheduler:
+    """
+    Per-chat queues inside priority lanes.
+    Lanes share the workers by smooth weighted round-robin over the lanes that have work, so a
+    cheap job waits behind at most a few expensive ones and Predict is never starved. Inside a lane
+    chats take turns one job at a time, and a chat with `max_chat_running` jobs running is skipped
+    until one of them is done: an album of 20 photos can't take every worker.
+    """
+
+    def __init__(self, lane_weights=LANE_WEIGHTS, max_chat_running=MAX_CHAT_RUNNING, max_chat_queued=MAX_CHAT_QUEUED):
+        self.lane_weights = lane_weights
+        self.max_chat_running = max_chat_running
+        self.max_chat_queued = max_chat_queued
+        self.lanes = {lane: OrderedDict() for lane in lane_weights}  # lane -> chat id -> deque of jobs, in turn order
+        self.current = dict.fromkeys(lane_weights, 0)
+        self.running = defaultdict(int)
+        self.queued = defaultdict(int)
+        self.waits = {lane: TimingStats() for lane in lane_weights}
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def put(self, job):
+        """Queues the job, returns False if its chat already has `max_chat_queued` jobs waiting"""
+        with self.condition:
+            if self.queued[job.chat_id] >= self.max_chat_queued:
+                return False
+            self.queued[job.chat_id] += 1
+            self.lanes[job.lane].setdefault(job.chat_id, deque()).append(job)
+            LANE_DEPTH.labels(job.lane).inc()
+            self.condition.notify()
+            return True
+
+    def get(self):
+        """Blocks until a job may run, returns None once closed and drained"""
+        with self.condition:
+            while True:
+                job = self._pick()
+                if job is not None:
+                    return job
+                if self.closed and not any(self.lanes.values()):
+                    return None
+                self.condition.wait()
+
+    def done(self, job):
+        with self.condition:
+            self.running[job.chat_id] -= 1
+            if not self.running[job.chat_id]:
+                del self.running[job.chat_id]
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _ready_chat(self, lane):
+        for chat_id in self.lanes[lane]:
+            # get(): indexing the defaultdict would add every waiting chat to the running ones
+            if self.running.get(chat_id, 0) < self.max_chat_running:
+                return chat_id
+        return None
+
+    def _pick(self):
+        ready = {lane: chat_id for lane in self.lanes if (chat_id := self._ready_chat(lane)) is not None}
+        if not ready:
+            return None
+
+        # smooth weighted round-robin (as in nginx) over the lanes that can dispatch
+        total = 0
+        for lane in ready:
+            self.current[lane] += self.lane_weights[lane]
+            total += self.lane_weights[lane]
+        lane = max(ready, key=lambda name: self.current[name])
+        self.current[lane] -= total
+
+        chats = self.lanes[lane]
+        chat_id = ready[lane]
+        job = chats[chat_id].popleft()
+        if chats[chat_id]:
+            chats.move_to_end(chat_id)
+        else:
+            del chats[chat_id]
+
+        self.queued[job.chat_id] -= 1
+        if not self.queued[job.chat_id]:
+            del self.queued[job.chat_id]
+        self.running[job.chat_id] += 1
+        wait = time.monotonic() - job.enqueued_at
+        self.waits[lane].add(wait)
+        LANE_DEPTH.labels(lane).dec()
+        LANE_WAIT_SECONDS.labels(lane).observe(wait)
+        return job
+
+    def stats(self):
+        with self.condition:
+            return {
+                lane: {
+                    'depth': sum(map(len, chats.values())),
+                    'chats': len(chats),
+                    'weight': self.lane_weights[lane],
+                    'wait_seconds': self.waits[lane].to_dict(),
+                }
+                for lane, chats in self.lanes.items()
+            } | {'running_chats': len(self.running), 'max_chat_depth': max(self.queued.values(), default=0)}
+
+
+class JobQueue:
+    """
+    Bounded pool that runs webhook work off the Flask request thread.
+    Telegram I/O runs on `max_workers` threads, CPU-bound filters on a separate process pool.
+    At most `max_workers + max_queue` jobs are accepted at once, `submit` refuses the rest.
+    Which job runs next is up to the FairScheduler.
+    """
+
+    def __init__(self, max_workers=4, max_queue=32, filter_workers=None, scheduler=None):
+        self.scheduler = scheduler or FairScheduler()
+        self.workers = [threading.Thread(target=self._work, name=f'job-{i}', daemon=True) for i in range(max_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.filter_executor = ProcessPoolExecutor(max_workers=filter_workers)
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.lock = threading.Lock()
+        self.queue_wait = TimingStats()
+        self.execution = TimingStats()
+        self.in_flight = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def submit(self, fn, *args, chat_id=None, lane='fast'):
+        """
+        Queues fn(*args) in `lane` for `chat_id`, returns False without queueing if the pool is
+        saturated or the chat already has too many jobs waiting
+        """
+        if not self.slots.acquire(blocking=False):
+            self._reject()
+            return False
+        if not self.scheduler.put(Job(fn, args, chat_id, lane)):
+            self.slots.release()
+            self._reject()
+            return False
+
+        with self.lock:
+            self.in_flight += 1
+        JOB_QUEUE_DEPTH.inc()
+        return True
+
+    def _reject(self):
+        with self.lock:
+            self.rejected += 1
+        JOBS_REJECTED.inc()
+
+    def _work(self):
+        while True:
+            job = self.scheduler.get()
+            if job is None:
+                return
+            try:
+                self._run(job.enqueued_at, job.fn, job.args)
+            finally:
+                self.scheduler.done(job)
+
+    def _run(self, enqueued_at, fn, args):
+        started_at = time.monotonic()
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f'Job failed: {e}')
+            with self.lock:
+                self.failed += 1
+        finally:
+            with self.lock:
+                self.queue_wait.add(started_at - enqueued_at)
+                self.execution.add(time.monotonic() - started_at)
+                self.in_flight -= 1
+            JOB_QUEUE_DEPTH.dec()
+            self.slots.release()
+
+    def run_filter(self, pipeline, img_path):
+        """Runs a filter pipeline in the process pool and waits for the filtered image path"""
+        return self.filter_executor.submit(pipeline.run, img_path).result()
+
+    def run_filter_bytes(self, pipeline, data, name):
+        """Same as run_filter, for the in-memory path, returns the encoded filtered image"""
+        return self.filter_executor.submit(pipeline.run_bytes, data, name).result()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'queue_wait_seconds': self.queue_wait.to_dict(),
+                'execution_seconds': self.execution.to_dict(),
+                'lanes': self.scheduler.stats(),
+            }
+
+    def shutdown(self):
+        self.scheduler.close()
+        for worker in self.workers:
+            worker.join()
+        self.filter_executor.shutdown(wait=True)
@@ -0,0 +1,202 @@
+import os
+import numpy as np
+
+# border mode -> np.pad mode, 'valid' doesn't pad and shrinks the image by the kernel size - 1
+BORDER_MODES = {
+    'reflect': 'symmetric',
+    'mirror': 'reflect',
+    'nearest': 'edge',
+    'wrap': 'wrap',
+    'constant': 'constant',
+    'valid': None,
+}
+
+# direct convolution costs about one pass over the image per kernel tap, an FFT about this many passes
+# per log2 of the pixel count; measured with benchmarks/bench_kernels.py
+FFT_PASSES_PER_LOG2 = 2
+
+# sigma comes from the caption, the kernel is 6 * sigma + 1 wide: this keeps one filter within the latency budget
+MAX_GAUSSIAN_SIGMA = float(os.environ.get('MAX_GAUSSIAN_SIGMA', 25))
+
+
+def gaussian_kernel_1d(sigma, truncate=3.0):
+    radius = max(1, int(truncate * sigma + 0.5))
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def gaussian_kernel(sigma, truncate=3.0):
+    k = gaussian_kernel_1d(sigma, truncate)
+    return np.outer(k, k)
+
+
+SHARPEN = np.array([[0, -1, 0], [-1, 5, -1], [0, -1, 0]], dtype=np.float64)
+SOBEL_X = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], dtype=np.float64)
+SOBEL_Y = SOBEL_X.T.copy()
+EMBOSS = np.array([[-2, -1, 0], [-1, 1, 1], [0, 1, 2]], dtype=np.float64)
+
+
+def separate(kernel, tol=1e-10):
+    """
+    Returns (column, row) 1D kernels whose outer product is `kernel` if it is separable (rank 1),
+    otherwise None
+    """
+    if kernel.shape[0] == 1:
+        return np.ones(1), kernel[0].copy()
+    if kernel.shape[1] == 1:
+        return kernel[:, 0].copy(), np.ones(1)
+    u, s, vt = np.linalg.svd(kernel)
+    if s[0] == 0 or s[1] > tol * s[0]:
+        return None
+    scale = np.sqrt(s[0])
+    return u[:, 0] * scale, vt[0] * scale
+
+
+def _correlate_1d(data, kernel, axis):
+    """Valid 1D correlation along `axis`, one vectorized pass per tap"""
+    n = data.shape[axis] - len(kernel) + 1
+    out = None
+    for i, weight in enumerate(kernel):
+        if weight == 0:
+            continue
+        part = data[i:i + n] if axis == 0 else data[:, i:i + n]
+        out = part * weight if out is None else out + part * weight
+    if out is None:
+        shape = (n, data.shape[1]) if axis == 0 else (data.shape[0], n)
+        out = np.zeros(shape)
+    return out
+
+
+def _correlate_2d(data, kernel):
+    """Valid 2D correlation, one vectorized pass per non-zero tap"""
+    kh, kw = kernel.shape
+    h, w = data.shape[0] - kh + 1, data.shape[1] - kw + 1
+    out = np.zeros((h, w))
+    for i in range(kh):
+        for j in range(kw):
+            if kernel[i, j] != 0:
+                out += kernel[i, j] * data[i:i + h, j:j + w]
+    return out
+
+
+def _convolve_fft(data, kernel):
+    """Valid 2D convolution through the real FFT"""
+    kh, kw = kernel.shape
+    shape = (data.shape[0] + kh - 1, data.shape[1] + kw - 1)
+    full = np.fft.irfft2(np.fft.rfft2(data, shape) * np.fft.rfft2(kernel, shape), shape)
+    return full[kh - 1:data.shape[0], kw - 1:data.shape[1]]
+
+
+def choose_method(shape, kernel, factors=None):
+    """
+    'separable', 'direct' or 'fft', whichever takes the fewest passes over the image
+    :param factors: the (column, row) 1D kernels of a kernel known to be separable, it isn't factored again
+    """
+    if factors is None:
+        factors = separate(kernel)
+    direct_passes = sum(map(len, factors)) if factors is not None else np.count_nonzero(kernel)
+    fft_passes = FFT_PASSES_PER_LOG2 * np.log2(max(2, shape[0] * shape[1]))
+    if direct_passes > fft_passes:
+        return 'fft'
+    return 'separable' if factors is not None else 'direct'
+
+
+def convolve(data, kernel, border='reflect', method=None, factors=None):
+    """
+    2D convolution of a grayscale image.
+    Separable kernels run as two 1D passes (O(kh + kw) per pixel instead of O(kh * kw)),
+    large kernels go through the FFT. With any border other than 'valid' the output has the
+    size of `data`.
+    `factors`, the (column, row) 1D kernels of a separable kernel, can be given instead of `kernel`:
+    nothing is factored and the 2D kernel is only built for the FFT.
+    """
+    if border not in BORDER_MODES:
+        raise ValueError(f'Unknown border mode: {border}')
+    if factors is not None:
+        factors = tuple(np.asarray(f, dtype=np.float64) for f in factors)
+        kh, kw = len(factors[0]), len(factors[1])
+    else:
+        kernel = np.asarray(kernel, dtype=np.float64)
+        kh, kw = kernel.shape
+
+    if BORDER_MODES[border] is not None:
+        pad = ((kh // 2, (kh - 1) // 2), (kw // 2, (kw - 1) // 2))
+        data = np.pad(data, pad, mode=BORDER_MODES[border])
+
+    method = method or choose_method(data.shape, kernel, factors)
+    if factors is not None and method != 'separable':
+        kernel = np.outer(*factors)
+    if method == 'fft':
+        return _convolve_fft(data, kernel)
+
+    # convolution is correlation with the flipped kernel
+    if method == 'separable':
+        if factors is None:
+            factors = separate(kernel)
+            if factors is None:
+                raise ValueError('Kernel is not separable')
+        column, row = factors
+        return _correlate_1d(_correlate_1d(data, column[::-1], axis=0), row[::-1], axis=1)
+    return _correlate_2d(data, kernel[::-1, ::-1])
+
+
+class Convolve:
+    """
+    Pipeline filter applying `kernel`. Padded borders need the whole image, so only
+    border='valid' can be filtered in bands.
+    """
+
+    def __init__(self, kernel, border='reflect', factors=None):
+        """:param factors: (column, row) 1D kernels, given instead of `kernel` when it is separable"""
+        self.kernel = None if kernel is None else np.asarray(kernel, dtype=np.float64)
+        self.factors = factors
+        self.border = border
+
+    @property
+    def halo(self):
+        height = len(self.factors[0]) if self.kernel is None else self.kernel.shape[0]
+        return height - 1 if self.border == 'valid' else None
+
+    def __call__(self, data, first_row=0):
+        return convolve(data, self.kernel, self.border, factors=self.factors)
+
+
+class Gaussian(Convolve):
+
+    def __init__(self, sigma=2, *, border='reflect'):
+        if not 0 < sigma <= MAX_GAUSSIAN_SIGMA:
+            raise ValueError(f'Gaussian sigma must be above 0 and at most {MAX_GAUSSIAN_SIGMA:g}, got {sigma}')
+        k = gaussian_kernel_1d(sigma)
+        super().__init__(None, border, factors=(k, k))
+
+
+class Sharpen(Convolve):
+
+    def __init__(self, *, border='reflect'):
+        super().__init__(SHARPEN, border)
+
+    def __call__(self, data, first_row=0):
+        return np.clip(super().__call__(data, first_row), 0, data.max(initial=0))
+
+
+class Emboss(Convolve):
+
+    def __init__(self, *, border='reflect'):
+        super().__init__(EMBOSS, border)
+
+
+class Sobel:
+    """Gradient magnitude of the horizontal and vertical Sobel kernels"""
+
+    def __init__(self, *, border='reflect'):
+        self.border = border
+
+    @property
+    def halo(self):
+        return 2 if self.border == 'valid' else None
+
+    def __call__(self, data, first_row=0):
+        gx = convolve(data, SOBEL_X, self.border)
+        gy = convolve(data, SOBEL_Y, self.border)
+        return np.hypot(gx, gy)
@@ -0,0 +1,49 @@
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
+
+# stages: telegram_download, telegram_send, filter, s3_upload, sqs_send, dynamodb_get, results
+STAGE_SECONDS = Histogram(
+    'polybot_stage_seconds', 'Time spent in each stage of a request', ['stage'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+FILTER_SECONDS = Histogram(
+    'polybot_filter_seconds', 'Time spent running a filter pipeline', ['filter'],
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+ERRORS = Counter('polybot_errors_total', 'Errors by stage', ['stage'])
+CACHE_REQUESTS = Counter('polybot_cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result'])
+JOB_QUEUE_DEPTH = Gauge('polybot_job_queue_depth', 'Jobs accepted by the job queue and not finished yet')
+JOBS_REJECTED = Counter('polybot_jobs_rejected_total', 'Messages refused because the job queue was full')
+LANE_DEPTH = Gauge('polybot_lane_depth', 'Jobs waiting in each scheduler lane', ['lane'])
+LANE_WAIT_SECONDS = Histogram(
+    'polybot_lane_wait_seconds', 'Time jobs waited in each scheduler lane before running', ['lane'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+@contextmanager
+def timed(stage):
+    """Records the duration of the block in STAGE_SECONDS, and in ERRORS if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+# chains of more stages than this share the "chain" label
+FILTER_LABEL_MAX_STAGES = 3
+
+
+def filter_label(pipeline):
+    """
+    The distinct stage names of the chain, sorted and without their arguments, e.g. "blur|salt and pepper".
+    Captions are written by users, so this keeps the label set bounded whatever they chain
+    """
+    if len(pipeline.stages) > FILTER_LABEL_MAX_STAGES:
+        return 'chain'
+    return '|'.join(sorted({name for name, _ in pipeline.stages}))
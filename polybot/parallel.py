@@ -0,0 +1,109 @@
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from imageproc import filter_tiled, filter_range, rgb2gray
+
+_executor = None
+_executor_workers = None
+
+
+def get_executor(workers):
+    """One band pool per process, created on first use"""
+    global _executor, _executor_workers
+    if _executor is None or _executor_workers != workers:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = ProcessPoolExecutor(max_workers=workers)
+        _executor_workers = workers
+    return _executor
+
+
+@atexit.register
+def _shutdown_executor():
+    if _executor is not None:
+        _executor.shutdown()
+
+
+def _band_range(in_name, in_shape, in_dtype, filters, start, stop, halo, max_band_bytes, convert):
+    """Runs in a pool worker: (min, max) of the filtered output rows [start, stop)"""
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    try:
+        rgb = np.ndarray(in_shape, dtype=in_dtype, buffer=shm_in.buf)
+        result = filter_range(rgb[start:stop + halo], filters, max_band_bytes, first_row=start, convert=convert)
+        del rgb
+        return result
+    finally:
+        shm_in.close()
+
+
+def _filter_band(in_name, in_shape, in_dtype, out_name, out_shape, out_dtype, filters, start, stop, halo,
+                 max_band_bytes, convert, band_range=None):
+    """
+    Runs in a pool worker: filters output rows [start, stop) straight between the shared buffers,
+    stretched to uint8 with `band_range` when given
+    """
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    shm_out = shared_memory.SharedMemory(name=out_name)
+    try:
+        rgb = np.ndarray(in_shape, dtype=in_dtype, buffer=shm_in.buf)
+        out = np.ndarray(out_shape, dtype=out_dtype, buffer=shm_out.buf)
+        out[start:stop] = filter_tiled(rgb[start:stop + halo], filters, max_band_bytes, first_row=start,
+                                       convert=convert, quantize=band_range is not None, band_range=band_range)
+        del rgb, out
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+
+def filter_parallel(rgb, filters, workers, max_band_bytes=0, convert=rgb2gray, quantize=False):
+    """
+    Same result as filter_tiled, with the image split into `workers` overlapping bands that are
+    filtered in a process pool. Pixels go through shared memory, only the buffer names and the
+    band bounds are pickled. `max_band_bytes` further limits the working memory of each worker.
+    With `quantize` the workers first report the range of their bands, then write uint8 bands.
+    """
+    if workers <= 1 or any(f.halo is None for f in filters):
+        return filter_tiled(rgb, filters, max_band_bytes, convert=convert, quantize=quantize)
+
+    halo = sum(f.halo for f in filters)
+    out_height = rgb.shape[0] - halo
+    if out_height < workers:
+        return filter_tiled(rgb, filters, max_band_bytes, convert=convert, quantize=quantize)
+
+    # run the chain on a single output row to learn the output width and type
+    sample = filter_tiled(np.zeros((halo + 1, *rgb.shape[1:]), dtype=rgb.dtype), filters, 0, convert=convert,
+                          quantize=quantize)
+    out_shape = (out_height, *sample.shape[1:])
+    out_dtype = sample.dtype.str
+
+    shm_in = shared_memory.SharedMemory(create=True, size=max(1, rgb.nbytes))
+    shm_out = shared_memory.SharedMemory(create=True, size=max(1, out_height * sample[0].nbytes))
+    try:
+        np.ndarray(rgb.shape, dtype=rgb.dtype, buffer=shm_in.buf)[:] = rgb
+
+        edges = np.linspace(0, out_height, workers + 1).astype(int).tolist()
+        bounds = list(zip(edges[:-1], edges[1:]))
+        executor = get_executor(workers)
+        band_range = None
+        if quantize:
+            ranges = [future.result() for future in [
+                executor.submit(_band_range, shm_in.name, rgb.shape, rgb.dtype.str, filters, start, stop, halo,
+                                max_band_bytes, convert)
+                for start, stop in bounds
+            ]]
+            band_range = (min(low for low, _ in ranges), max(high for _, high in ranges))
+        futures = [
+            executor.submit(_filter_band, shm_in.name, rgb.shape, rgb.dtype.str, shm_out.name, out_shape, out_dtype,
+                            filters, start, stop, halo, max_band_bytes, convert, band_range)
+            for start, stop in bounds
+        ]
+        for future in futures:
+            future.result()
+
+        return np.ndarray(out_shape, dtype=out_dtype, buffer=shm_out.buf).copy()
+    finally:
+        shm_in.close()
+        shm_in.unlink()
+        shm_out.close()
+        shm_out.unlink()
@@ -0,0 +1,134 @@
+import os
+import re
+from io import BytesIO
+from imageproc import Img, Blur, Contour, SaltNPepper, PerChannel, filter_tiled, keep_rgb8, rgb2gray
+from kernels import Gaussian, Sharpen, Sobel, Emboss
+from parallel import filter_parallel
+
+
+# stage name -> filter class, constructed with the stage's optional integer arguments
+STAGES = {
+    'blur': Blur,
+    'contour': Contour,
+    'salt and pepper': SaltNPepper,
+    'gaussian': Gaussian,
+    'sharpen': Sharpen,
+    'sobel': Sobel,
+    'emboss': Emboss,
+}
+
+# working memory per band for large images, 0 filters the whole image at once
+MAX_BAND_BYTES = int(os.environ.get('FILTER_MAX_BAND_BYTES', 0))
+# processes splitting each image into bands, 0 or 1 filters in the calling process
+PARALLEL_WORKERS = int(os.environ.get('FILTER_PARALLEL_WORKERS', 0))
+# keep the colors: filter each channel of a uint8 RGB image instead of a float64 grayscale one
+COLOR = os.environ.get('FILTER_COLOR', 'false').lower() == 'true'
+
+# captions that expand to a whole chain
+ALIASES = {
+    'mix': 'salt and pepper | blur',
+}
+
+
+class Pipeline:
+
+    def __init__(self, stages, max_band_bytes=MAX_BAND_BYTES, workers=PARALLEL_WORKERS, color=COLOR):
+        """
+        :param stages: list of (stage name, args tuple), applied in order
+        :param max_band_bytes: when set, filter in horizontal bands within this working memory
+        :param workers: when above 1, filter bands in parallel in that many processes
+        :param color: filter the RGB channels of a uint8 image instead of its grayscale conversion
+        """
+        self.stages = stages
+        self.max_band_bytes = max_band_bytes
+        self.workers = workers
+        self.color = color
+
+    def __repr__(self):
+        return ' | '.join(' '.join([name, *map(str, args)]) for name, args in self.stages)
+
+    def filters(self):
+        # new instances on every run, so salt and pepper draws a new seed each time
+        filters = [STAGES[name](*args) for name, args in self.stages]
+        if self.color:
+            filters = [PerChannel(f) for f in filters]
+        return filters
+
+    def apply(self, img):
+        """Runs every stage on the in-memory image buffer, no intermediate encode/decode"""
+        for f in self.filters():
+            img.data = f(img.data)
+        return img
+
+    @property
+    def uses_engine(self):
+        return self.color or bool(self.max_band_bytes) or self.workers > 1
+
+    def engine(self, rgb):
+        """Filters a decoded RGB image, band by band and in parallel when configured"""
+        filters = self.filters()
+        convert = keep_rgb8 if self.color else rgb2gray
+        # grayscale results come back as the uint8 pixels that get encoded, see filter_tiled
+        if self.workers > 1:
+            return filter_parallel(rgb, filters, self.workers, self.max_band_bytes, convert=convert,
+                                   quantize=not self.color)
+        return filter_tiled(rgb, filters, self.max_band_bytes, convert=convert, quantize=not self.color)
+
+    def run(self, img_path):
+        """Decodes `img_path` once, applies the chain and encodes the result once"""
+        if self.uses_engine:
+            img = Img.filtered(img_path, img_path, self.engine, color=self.color)
+        else:
+            img = self.apply(Img(img_path))
+        return img.save_img()
+
+    def run_bytes(self, data, name):
+        """Same as run, but decodes from and encodes to memory, `name` only provides the image format"""
+        if self.uses_engine:
+            img = Img.filtered(BytesIO(data), name, self.engine, color=self.color)
+        else:
+            img = self.apply(Img.from_bytes(data, name))
+        return img.encode()
+
+
+def _normalize(text):
+    return re.sub(r'\s+', ' ', text.strip().lower())
+
+
+def _parse_stage(segment):
+    # stage names may contain spaces ("salt and pepper"), so match the longest known name first
+    for name in sorted(STAGES, key=len, reverse=True):
+        if segment == name or segment.startswith(name + ' '):
+            args = segment[len(name):].split()
+            if not all(arg.isdigit() for arg in args):
+                raise ValueError(f'Invalid arguments for {name}: {" ".join(args)}')
+            args = tuple(int(arg) for arg in args)
+            try:
+                # build the filter once so a wrong count or value of arguments fails here, not mid-run
+                STAGES[name](*args)
+            except TypeError as e:
+                raise ValueError(f'Invalid arguments for {name}: {" ".join(map(str, args))}') from e
+            except ValueError as e:
+                raise ValueError(f'Invalid arguments for {name}: {e}') from e
+            return name, args
+
+    raise ValueError(f'Unknown filter: {segment}')
+
+
+def parse_caption(caption):
+    """
+    Parses a caption like "salt and pepper | blur 8 | contour" into a Pipeline.
+    Raises ValueError if any stage is unknown or has bad arguments.
+    """
+    stages = []
+    for segment in _normalize(caption).split('|'):
+        segment = _normalize(segment)
+        if not segment:
+            raise ValueError(f'Empty filter in caption: {caption}')
+
+        if segment in ALIASES:
+            stages.extend(parse_caption(ALIASES[segment]).stages)
+        else:
+            stages.append(_parse_stage(segment))
+
+    return Pipeline(stages)
@@ -1,4 +1,4 @@
-import boto3
+import aws_clients
 import logging
 import os
 from botocore.exceptions import ClientError
@@ -27,40 +27,12 @@ def upload_file(file_name, bucket, s3_client, object_name=None):
     return True
 
 
-def count_objects_in_list(my_list):
-    obj_count = {}
-    for i in my_list:
-        obj_name = i.get('M').get('class').get('S')
-
-        if obj_count.get(obj_name) is None:
-            obj_count[obj_name] = 1
-        else:
-            obj_count[obj_name] = obj_count[obj_name] + 1
-
-    return obj_count
-
-
-def parse_info_to_text(obj_count_dict):
-    text = ""
-    for key, value in obj_count_dict.items():
-        if value > 1:
-            text = text + f"there are {value} {key}s,\n"
-        else:
-            text = text + f"there is 1 {key},\n"
-
-    return text
-
-
 def get_secret(secret_name):
 
     region_name = "us-west-1"
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+    # Shared Secrets Manager client
+    client = aws_clients.get_client('secretsmanager', region_name=region_name)
 
     try:
         get_secret_value_response = client.get_secret_value(
@@ -72,4 +44,5 @@ def get_secret(secret_name):
         raise e
 
     secret = get_secret_value_response['SecretString']
-    return secret
\ No newline at end of file
+    return secret
+
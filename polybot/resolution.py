@@ -0,0 +1,94 @@
+import os
+from io import BytesIO
+
+# longest side, in pixels, each operation needs: "predict" for YOLO, which letterboxes to 640 anyway,
+# "default" for the filters, and a normalized caption ("blur", "salt and pepper | blur") to override it.
+# 0 keeps the original resolution.
+RESOLUTION_POLICY = os.environ.get('RESOLUTION_POLICY', 'predict=640,default=1280')
+# resize locally when the smallest photo size Telegram offers is still larger than the target
+RESOLUTION_DOWNSCALE = os.environ.get('RESOLUTION_DOWNSCALE', 'true').lower() == 'true'
+
+PIL_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'bmp': 'BMP'}
+
+
+def parse_policy(text):
+    """"predict=640, default=1280, blur=720" -> {operation: longest side}"""
+    targets = {}
+    for item in filter(None, (item.strip() for item in text.split(','))):
+        operation, target = item.rsplit('=', 1)
+        targets[' '.join(operation.lower().split())] = int(target)
+    return targets
+
+
+def long_side(photo_size):
+    return max(photo_size.get('width', 0), photo_size.get('height', 0))
+
+
+def pick_photo_size(photo_sizes, target):
+    """
+    The smallest of the PhotoSizes of a message (Telegram lists them smallest first) whose longest
+    side is at least `target`, the largest one if none is or the sizes aren't known
+    """
+    if target:
+        for photo_size in photo_sizes:
+            if long_side(photo_size) >= target:
+                return photo_size
+    return photo_sizes[-1]
+
+
+def downscale(data, name, target):
+    """
+    Resizes the encoded image so its longest side is `target`, in its own format.
+    JPEGs are decoded at a reduced scale first (draft mode), then resampled with a reducing gap,
+    which is much faster than a full decode and a plain resize.
+    :return: (bytes, (width, height)), `data` itself when it is already small enough
+    """
+    from PIL import Image  # Pillow is only needed when Telegram has no small enough size
+
+    with Image.open(BytesIO(data)) as image:
+        width, height = image.size
+        if not target or max(width, height) <= target:
+            return data, (width, height)
+
+        ratio = target / max(width, height)
+        size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+        image.draft('RGB', size)
+        resized = image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+
+    buffer = BytesIO()
+    resized.save(buffer, format=PIL_FORMATS.get(name.rsplit('.', 1)[-1].lower(), 'PNG'), quality=90)
+    return buffer.getvalue(), size
+
+
+class ResolutionPolicy:
+    """
+    Decides at which resolution a photo is downloaded, filtered and sent for prediction.
+    The scale factor (original longest side / longest side used) goes with the prediction job,
+    so the detections can be mapped back to the photo the user sent.
+    """
+
+    def __init__(self, targets=None, allow_downscale=RESOLUTION_DOWNSCALE):
+        self.targets = parse_policy(RESOLUTION_POLICY) if targets is None else targets
+        self.allow_downscale = allow_downscale
+
+    def target(self, operation):
+        return self.targets.get(operation, self.targets.get('default', 0))
+
+    def choose(self, photo_sizes, operation):
+        """:return: (PhotoSize to download, target longest side)"""
+        target = self.target(operation)
+        return pick_photo_size(photo_sizes, target), target
+
+    def fit(self, data, name, photo_size, target, original_size):
+        """
+        Downscales the downloaded photo to `target` when allowed.
+        :param photo_size: the PhotoSize `data` was downloaded as
+        :param original_size: the largest PhotoSize of the message
+        :return: (bytes, scale)
+        """
+        used = long_side(photo_size)
+        if self.allow_downscale and target:
+            data, size = downscale(data, name, target)
+            used = max(size)
+        original = long_side(original_size)
+        return data, (original / used if original and used else 1.0)
@@ -0,0 +1,118 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalTier:
+    """In-process TTL + LRU map of bytes values, bounded by their total size"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries = OrderedDict()  # key -> (expires at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, value = self.entries.pop(key)
+        self.size -= len(value)
+
+
+class RedisTier:
+    """Shared between pods through redis, expiry is handled by redis itself"""
+
+    def __init__(self, url, ttl=3600, prefix='polybot:results:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+
+class ResultCache:
+    """
+    Caches results by image content, so a forwarded photo is answered without being processed again.
+    Looks up the local tier first, then the shared one (if any), values are bytes.
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self._count('shared_hits')
+                self.local.set(key, value)
+                return value
+
+        self._count('misses')
+        return None
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+def content_key(msg, data=None):
+    """
+    Identifies the photo of a message by content: Telegram's file_unique_id is the same for every
+    forward of a photo and is known before downloading, the sha256 of the bytes is the fallback
+    """
+    file_unique_id = msg.get('photo', [{}])[-1].get('file_unique_id')
+    if file_unique_id:
+        return file_unique_id
+    if data is not None:
+        return hashlib.sha256(data).hexdigest()
+    return None
+
+
+def create_result_cache(max_bytes=64 * 1024 * 1024, ttl=3600, redis_url=None):
+    shared = RedisTier(redis_url, ttl=ttl) if redis_url else None
+    return ResultCache(LocalTier(max_bytes=max_bytes, ttl=ttl), shared)
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import telebot
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+
+# Telegram allows about 30 messages per second overall and 1 per second in a chat, with short bursts
+GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+SEND_WORKERS = int(os.environ.get('TELEGRAM_SEND_WORKERS', 8))
+# e.g. http://127.0.0.1:8081 to run against a local fake of the Bot API
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+
+
+def configure_session(pool_size=SEND_WORKERS * 2, api_url=TELEGRAM_API_URL):
+    """
+    One keep-alive connection pool shared by every thread. By default telebot gives each thread
+    its own session, recreated every 10 minutes, so every job thread paid for its own TLS handshake.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    apihelper.session = session
+    apihelper.SESSION_TIME_TO_LIVE = None
+    if api_url:
+        apihelper.API_URL = api_url.rstrip('/') + '/bot{0}/{1}'
+        apihelper.FILE_URL = api_url.rstrip('/') + '/file/bot{0}/{1}'
+
+
+class TokenBucket:
+    """`rate` tokens per second, up to `capacity` saved up for bursts"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token, returns how many seconds the caller has to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class ChatRateLimiter:
+    """A global bucket plus one bucket per chat, the buckets of idle chats are evicted first"""
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, max_chats=10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.chats = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        with self.lock:
+            bucket = self.chats.get(chat_id)
+            if bucket is None:
+                bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                if len(self.chats) > self.max_chats:
+                    self.chats.popitem(last=False)
+            else:
+                self.chats.move_to_end(chat_id)
+        # wait for the chat first, the global token is only taken when the message can go out
+        bucket.acquire()
+        self.global_bucket.acquire()
+
+
+class TelegramClient:
+    """
+    telebot.TeleBot behind a shared keep-alive session and a per-chat rate limiter.
+    The *_async methods return a Future, so status messages go out while the caller keeps working.
+    Sends rejected with 429 are retried after the delay Telegram asks for.
+    """
+
+    def __init__(self, token, limiter=None, send_workers=SEND_WORKERS, retries=3):
+        configure_session(pool_size=send_workers * 2)
+        self.bot = telebot.TeleBot(token)
+        self.limiter = limiter or ChatRateLimiter()
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=send_workers, thread_name_prefix='telegram')
+
+    def __getattr__(self, name):
+        # get_file, download_file, get_webhook_info, set_webhook... aren't rate limited
+        return getattr(self.bot, name)
+
+    def _send(self, chat_id, method, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire(chat_id)
+            try:
+                return method(chat_id, *args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt == self.retries:
+                    raise
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                logger.warning(f'Rate limited by Telegram in chat {chat_id}, retrying in {retry_after}s')
+                time.sleep(retry_after)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._send(chat_id, self.bot.send_message, text, **kwargs)
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self._send(chat_id, self.bot.send_photo, photo, **kwargs)
+
+    def send_message_async(self, chat_id, text, **kwargs):
+        return self.executor.submit(self.send_message, chat_id, text, **kwargs)
@@ -0,0 +1,37 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from imageproc import Img, box_sum
+from pipeline import Pipeline, parse_caption
+
+
+def jpeg(width, height):
+    rgb = (np.random.default_rng(0).random((height, width, 3)) * 255).astype(np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(rgb).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def test_box_sum_window_taller_than_image():
+    data = np.ones((300, 400))
+    assert box_sum(data, 350).shape == (0, 51)
+    assert box_sum(data, 500).shape == (0, 0)
+
+
+def test_box_sum_window_fits():
+    data = np.arange(20, dtype=np.float64).reshape(4, 5)
+    assert np.array_equal(box_sum(data, 4), [[data[:, :4].sum(), data[:, 1:].sum()]])
+
+
+@pytest.mark.parametrize('options', [{}, {'max_band_bytes': 1 << 20}])
+def test_blur_larger_than_image_is_empty(options):
+    pipeline = Pipeline(parse_caption('Blur 350').stages, **options)
+    data = jpeg(400, 300)
+    if pipeline.uses_engine:
+        filtered = Img.filtered(BytesIO(data), 'photo.jpg', pipeline.engine).data
+    else:
+        filtered = pipeline.apply(Img.from_bytes(data, 'photo.jpg')).data
+    assert filtered.shape == (0, 51)
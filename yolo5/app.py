@@ -1,13 +1,29 @@
+import math
 import time
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from detect import run
-import yaml
+import cv2
+import numpy as np
+import torch
 from loguru import logger
 import os
-import boto3
+import sys
+import aws_clients
 import json
 import polybot_supp
-import requests
+import dynamo
+import autoscale
+from predictor import Predictor
+from delivery import ResultDelivery
+from consumer import ConsumerRuntime
+from metrics import timed, start_metrics_server, clear_stale_metrics, mark_process_dead, MESSAGES
+
+# every log line carries the trace id (polybot's prediction id) of the message it belongs to, "-" outside of one
+logger.configure(
+    handlers=[{'sink': sys.stderr, 'format': '{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {extra[trace_id]} | {name}:{function}:{line} - {message}'}],
+    extra={'trace_id': '-'},
+)
 
 # Environment variables
 S3_IMAGE_BUCKET = os.environ['S3_BUCKET']
@@ -15,89 +31,277 @@ SQS_QUEUE_URL = os.environ['SQS_QUEUE_URL']
 DYNAMODB_TABLE_NAME = os.environ['DYNAMO_NAME']
 TELEGRAM_APP_URL = os.environ["TELEGRAM_APP_URL"]
 
+# Micro-batching: up to BATCH_SIZE messages, waiting at most BATCH_MAX_WAIT seconds after the first one to fill a batch
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 1))
+BATCH_MAX_WAIT = float(os.environ.get('BATCH_MAX_WAIT', 1))
+SQS_MAX_MESSAGES = 10
+
+# Worker processes fed by the single poller, and the visibility heartbeat that keeps their messages hidden
+WORKERS = int(os.environ.get('WORKERS', 1))
+VISIBILITY_TIMEOUT = int(os.environ.get('VISIBILITY_TIMEOUT', 60))
+HEARTBEAT_INTERVAL = int(os.environ.get('HEARTBEAT_INTERVAL', 20))
+
+# Stream images between S3 and memory instead of going through the local disk
+ZERO_DISK = os.environ.get('ZERO_DISK', 'true').lower() == 'true'
+
+# Results that can't be posted to polybot go to this queue, polybot drains it in batches
+RESULTS_QUEUE_URL = os.environ.get('RESULTS_QUEUE_URL')
+
+# Summaries are written in batches of up to 25, at most DYNAMO_FLUSH_INTERVAL seconds after they were produced
+DYNAMO_FLUSH_INTERVAL = float(os.environ.get('DYNAMO_FLUSH_INTERVAL', 1))
+
 
 # AWS clients
-sqs_client = boto3.client('sqs', region_name='us-west-1')
-s3_client = boto3.client('s3')
-dynamo_client = boto3.client('dynamodb', region_name='us-west-1')
+sqs_client = aws_clients.get_client('sqs', region_name='us-west-1')
+s3_client = aws_clients.get_client('s3')
+dynamo_client = aws_clients.get_client('dynamodb', region_name='us-west-1')
 
-# Load class names from YAML file
-with open("data/coco128.yaml", "r") as stream:
-    names = yaml.safe_load(stream)['names']
+# Loaded once at startup and reused for every message
+predictor = Predictor(weights='yolov5s.pt', data='data/coco128.yaml')
 
-def consume():
-    logger.info("Start running...")
-    while True:
+download_executor = ThreadPoolExecutor(max_workers=SQS_MAX_MESSAGES)
+
+
+def create_delivery():
+    return ResultDelivery(f"http://{TELEGRAM_APP_URL}/results", sqs_client=sqs_client, results_queue_url=RESULTS_QUEUE_URL)
+
+
+def create_summary_writer():
+    return dynamo.WriteBehindBuffer(dynamo_client, DYNAMODB_TABLE_NAME, flush_interval=DYNAMO_FLUSH_INTERVAL)
+
+
+delivery = create_delivery()
+# only used by the poller: queue depth and processing rate for the autoscaler, and the adaptive long poll
+rate_meter = autoscale.RateMeter()
+queue_monitor = autoscale.QueueMonitor(sqs_client, SQS_QUEUE_URL, workers=WORKERS, rate_meter=rate_meter)
+poller = autoscale.AdaptivePoller(sqs_client, SQS_QUEUE_URL, monitor=queue_monitor)
+# DynamoDB keeps the history of predictions, it is written off the latency path
+summary_writer = create_summary_writer()
+
+
+def init_worker(worker_id):
+    """Runs in each forked worker: fresh clients and thread pool, and a fair share of the cores for torch"""
+    global sqs_client, s3_client, dynamo_client, download_executor, delivery, summary_writer
+    # the registry was reset by the fork, these are new clients with their own connections
+    sqs_client = aws_clients.get_client('sqs', region_name='us-west-1')
+    s3_client = aws_clients.get_client('s3')
+    dynamo_client = aws_clients.get_client('dynamodb', region_name='us-west-1')
+    download_executor = ThreadPoolExecutor(max_workers=SQS_MAX_MESSAGES)
+    delivery = create_delivery()
+    summary_writer = create_summary_writer()
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // WORKERS))
+    logger.info(f'Worker {worker_id} started')
+
+
+def exit_worker(worker_id):
+    """Runs in each worker before it exits: the summaries still buffered must not be lost"""
+    summary_writer.close()
+    mark_process_dead(os.getpid())
+
+
+def receive_batch(batch_size=BATCH_SIZE, max_wait=BATCH_MAX_WAIT):
+    """
+    Receives up to `batch_size` messages: the first receive waits as long as the poller decides
+    (20 s when idle, not at all under a backlog), the following ones top up the batch until it is
+    full or `max_wait` has passed
+    """
+    messages = poller.receive(min(SQS_MAX_MESSAGES, batch_size))
+    deadline = time.monotonic() + max_wait
+    while messages and len(messages) < batch_size and time.monotonic() < deadline:
+        # long poll for at least 1 s: a wait of 0 would turn the rest of the window into a loop of empty receives
+        wait_time = max(1, min(20, math.ceil(deadline - time.monotonic())))
+        more = poller.receive(min(SQS_MAX_MESSAGES, batch_size - len(messages)), wait_time=wait_time)
+        if not more:
+            # it waited out the window, nothing else is coming in time
+            break
+        messages.extend(more)
+    return messages
+
+
+def trace_id(sqs_message):
+    """polybot's prediction id, which follows the job from the webhook to /results"""
+    return json.loads(sqs_message['Body']).get('prediction_id') or sqs_message['MessageId']
+
+
+def read_job(sqs_message):
+    """
+    The prediction job polybot queued (ObjectDetectionBot.request_prediction), with the S3 key of
+    the photo: polybot uploads it under the basename of imgName
+    """
+    message = json.loads(sqs_message['Body'])
+    return message, Path(message['imgName']).name
+
+
+def download_image(sqs_message):
+    _, img_name = read_job(sqs_message)
+    with logger.contextualize(trace_id=trace_id(sqs_message)), timed('s3_download'):
+        if ZERO_DISK:
+            buffer = BytesIO()
+            s3_client.download_fileobj(S3_IMAGE_BUCKET, img_name, buffer)
+            img = cv2.imdecode(np.frombuffer(buffer.getbuffer(), dtype=np.uint8), cv2.IMREAD_COLOR)
+        else:
+            s3_client.download_file(S3_IMAGE_BUCKET, img_name, img_name)
+            img = cv2.imread(img_name)
+        logger.info(f'Prediction: {sqs_message["MessageId"]}/{img_name}. Download img completed')
+    return img
+
+
+def upload_annotated(img, det, img_name, predicted_img_path):
+    annotated = predictor.annotate(img, det)
+    with timed('s3_upload'):
+        _upload_annotated(annotated, img_name, predicted_img_path)
+
+
+def _upload_annotated(annotated, img_name, predicted_img_path):
+    if ZERO_DISK:
+        ok, encoded = cv2.imencode(Path(img_name).suffix or '.jpg', annotated)
+        if not ok:
+            raise RuntimeError(f'Could not encode {img_name}')
+        s3_client.upload_fileobj(BytesIO(encoded.tobytes()), S3_IMAGE_BUCKET, f"predicted_img/{img_name}")
+    else:
+        predicted_img_path.parent.mkdir(parents=True, exist_ok=True)
+        cv2.imwrite(str(predicted_img_path), annotated)
+        polybot_supp.upload_file(predicted_img_path, S3_IMAGE_BUCKET, s3_client, f"predicted_img/{img_name}")
+
+
+def handle_result(sqs_message, img, det):
+    """
+    Uploads the annotated image and publishes the prediction summary of a single message.
+    :return: the Future of the delivery to polybot, None when there was nothing to deliver
+    """
+    message, img_name = read_job(sqs_message)
+    prediction_id = sqs_message['MessageId']
+    chat_id = message['chat_id']
+    original_img_path = img_name
+
+    logger.info(f'Prediction: {prediction_id}/{original_img_path}. Done')
+
+    predicted_img_path = Path(f'static/data/{prediction_id}/{original_img_path}')
+    upload_annotated(img, det, img_name, predicted_img_path)
+    if ZERO_DISK:
+        # nothing was written locally, point at the uploaded S3 object instead
+        predicted_img_path = Path(f'predicted_img/{img_name}')
+
+    if len(det):
+        detections = predictor.to_detections(det, img.shape)
+
+        logger.info(f'Prediction: {prediction_id}/{original_img_path}. Prediction summary:\n\n{detections}')
+
+        prediction_summary = {
+            'prediction_id': prediction_id,
+            'chat_id': chat_id,
+            'original_img_path': original_img_path,
+            'predicted_img_path': str(predicted_img_path),
+            **detections.to_item(),
+            'time': time.time()
+        }
+        if message.get('content_hash'):
+            # lets polybot cache this summary for later forwards of the same photo
+            prediction_summary['content_hash'] = message['content_hash']
+        # polybot may have sent a downscaled copy, the boxes are relative so the original size is all it takes
+        # to map them back to the user's photo (Detections.to_pixels), the scale says how much smaller it was
+        for key in ('scale', 'original_width', 'original_height'):
+            prediction_summary[key] = message.get(key)
+
+        summary_writer.put(dynamo.to_item(prediction_summary))
+        # the summary travels with the notification, polybot doesn't need to read it back from DynamoDB
+        return delivery.deliver({
+            'predictionId': prediction_id,
+            'traceId': message.get('prediction_id'),
+            'chat_id': chat_id,
+            'detections': detections.to_json(),
+            'content_hash': message.get('content_hash'),
+        })
+    else:
+        logger.info("NOTHING TO PREDICT!")
+        return None
+
+
+def process_batch(messages):
+    """Runs a batch end to end and returns the messages that were fully processed"""
+    for sqs_message in messages:
+        logger.info(f'Prediction: {sqs_message["MessageId"]}. Start processing')
+
+    # download concurrently, a failed download only drops its own message
+    downloads = [download_executor.submit(download_image, m) for m in messages]
+    ready = []
+    for sqs_message, future in zip(messages, downloads):
         try:
-            response = sqs_client.receive_message(QueueUrl=SQS_QUEUE_URL, MaxNumberOfMessages=1, WaitTimeSeconds=5)
-            if 'Messages' in response:
-                message = json.loads(response['Messages'][0]['Body'])
-                receipt_handle = response['Messages'][0]['ReceiptHandle']
-                prediction_id = response['Messages'][0]['MessageId']
-
-                logger.info(f'Prediction: {prediction_id}. Start processing')
-
-                img_name = message.get("img_name")
-                chat_id = message.get("msg_id")
-                s3_client.download_file(S3_IMAGE_BUCKET, img_name, img_name)
-                original_img_path = img_name
-
-                logger.info(f'Prediction: {prediction_id}/{original_img_path}. Download img completed')
-
-                run(
-                    weights='yolov5s.pt',
-                    data='data/coco128.yaml',
-                    source=original_img_path,
-                    project='static/data',
-                    name=prediction_id,
-                    save_txt=True
-                )
-
-                logger.info(f'Prediction: {prediction_id}/{original_img_path}. Done')
-
-                predicted_img_path = Path(f'static/data/{prediction_id}/{original_img_path}')
-                polybot_supp.upload_file(predicted_img_path, S3_IMAGE_BUCKET, s3_client, f"predicted_img/{img_name}")
-
-                pred_summary_path = Path(f'static/data/{prediction_id}/labels/{original_img_path.split(".")[0]}.txt')
-                if pred_summary_path.exists():
-                    with open(pred_summary_path) as f:
-                        labels = f.read().splitlines()
-                        labels = [line.split(' ') for line in labels]
-                        labels = [{
-                            'class': names[int(l[0])],
-                            'cx': float(l[1]),
-                            'cy': float(l[2]),
-                            'width': float(l[3]),
-                            'height': float(l[4]),
-                        } for l in labels]
-
-                    logger.info(f'Prediction: {prediction_id}/{original_img_path}. Prediction summary:\n\n{labels}')
-
-                    prediction_summary = {
-                        'prediction_id': prediction_id,
-                        'chat_id': chat_id,
-                        'original_img_path': original_img_path,
-                        'predicted_img_path': str(predicted_img_path),
-                        'labels': labels,
-                        'time': time.time()
-                    }
-
-
-                    dynamo_client.put_item(
-                        TableName=DYNAMODB_TABLE_NAME,
-                        Item=polybot_supp.dict_to_dynamo_format(prediction_summary)
-                    )
-
-                    logger.info(f"http://{TELEGRAM_APP_URL}/results?predictionId={prediction_id}")
-
-                    requests.post(f"http://{TELEGRAM_APP_URL}/results?predictionId={prediction_id}")
-                else:
-                    logger.info("NOTHING TO PREDICT!")
-
-                logger.info("Prediction done, keep running")
-                sqs_client.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=receipt_handle)
+            img = future.result()
+            if img is None:
+                raise RuntimeError('image could not be decoded')
+            ready.append((sqs_message, img))
         except Exception as e:
-            logger.error(f"Error processing message: {e}")
+            logger.error(f'Prediction: {sqs_message["MessageId"]}. Download failed: {e}')
+
+    if not ready:
+        return []
+
+    with timed('inference'):
+        dets = predictor.detect_batch([img for _, img in ready])
+
+    handled = []
+    for (sqs_message, img), det in zip(ready, dets):
+        with logger.contextualize(trace_id=trace_id(sqs_message)):
+            try:
+                handled.append((sqs_message, handle_result(sqs_message, img, det)))
+            except Exception as e:
+                logger.error(f'Prediction: {sqs_message["MessageId"]}. Error processing message: {e}')
+
+    # a message is only deleted once its result reached polybot or the results queue,
+    # otherwise SQS redelivers it after the visibility timeout and the prediction runs again
+    succeeded = []
+    for sqs_message, delivery_future in handled:
+        with logger.contextualize(trace_id=trace_id(sqs_message)):
+            try:
+                delivered = delivery_future is None or delivery_future.result()
+            except Exception as e:
+                logger.error(f'Prediction: {sqs_message["MessageId"]}. Error delivering the result: {e}')
+                delivered = False
+            if delivered:
+                succeeded.append(sqs_message)
+            else:
+                logger.error(f'Prediction: {sqs_message["MessageId"]}. Result not delivered, leaving it to be redelivered')
+    MESSAGES.labels('succeeded').inc(len(succeeded))
+    MESSAGES.labels('failed').inc(len(messages) - len(succeeded))
+    return succeeded
+
+
+def delete_messages(messages):
+    # delete_message_batch accepts at most 10 entries per call
+    for start in range(0, len(messages), SQS_MAX_MESSAGES):
+        chunk = messages[start:start + SQS_MAX_MESSAGES]
+        response = sqs_client.delete_message_batch(
+            QueueUrl=SQS_QUEUE_URL,
+            Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(chunk)]
+        )
+        for failed in response.get('Failed', []):
+            logger.error(f'Failed to delete message {chunk[int(failed["Id"])]["MessageId"]}: {failed.get("Message")}')
+
+
+def consume():
+    logger.info(f"Start running... {WORKERS} workers, batch size {BATCH_SIZE}, max wait {BATCH_MAX_WAIT}s")
+    # the workers write their metrics to files named after their pid, the ones of an earlier run would be summed too
+    clear_stale_metrics()
+    start_metrics_server()
+    queue_monitor.start()
+    runtime = ConsumerRuntime(
+        sqs_client,
+        SQS_QUEUE_URL,
+        receive_batch=receive_batch,
+        process_batch=process_batch,
+        delete_messages=delete_messages,
+        workers=WORKERS,
+        visibility_timeout=VISIBILITY_TIMEOUT,
+        heartbeat_interval=HEARTBEAT_INTERVAL,
+        worker_init=init_worker,
+        worker_exit=exit_worker,
+        on_processed=lambda messages, succeeded: rate_meter.add(len(messages)),
+        # a killed worker never ran exit_worker, its live gauges would stay in the sums
+        on_worker_died=lambda worker_id, pid: mark_process_dead(pid),
+    )
+    runtime.run()
+
 
 if __name__ == "__main__":
     consume()
@@ -0,0 +1,124 @@
+import math
+import os
+import threading
+import time
+from loguru import logger
+from metrics import timed, QUEUE_MESSAGES, BACKLOG_PER_WORKER, OLDEST_MESSAGE_AGE, PROCESSING_RATE, RECEIVES
+
+# long poll while the queue is idle, 20 s is the most SQS allows
+IDLE_WAIT = int(os.environ.get('POLL_IDLE_WAIT', 20))
+# how often the queue attributes are read, each read is one SQS request
+QUEUE_STATS_INTERVAL = float(os.environ.get('QUEUE_STATS_INTERVAL', 15))
+# seconds after which a batch counts for half as much in the images per second average
+RATE_HALF_LIFE = float(os.environ.get('RATE_HALF_LIFE', 30))
+
+
+class QueueMonitor:
+    """
+    Reads the approximate queue depth in the background and publishes it, with the backlog per
+    worker process, for an autoscaler (Prometheus adapter, KEDA) to scale the deployment on
+    """
+
+    def __init__(self, sqs_client, queue_url, workers=1, interval=QUEUE_STATS_INTERVAL, rate_meter=None):
+        """
+        :param rate_meter: RateMeter decayed on every refresh, so it falls to 0 while nothing is processed
+        """
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.workers = workers
+        self.interval = interval
+        self.rate_meter = rate_meter
+        self.visible = 0
+        self.in_flight = 0
+
+    def start(self):
+        threading.Thread(target=self._run, name='queue-monitor', daemon=True).start()
+        return self
+
+    def refresh(self):
+        response = self.sqs_client.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'],
+        )
+        attributes = response.get('Attributes', {})
+        self.visible = int(attributes.get('ApproximateNumberOfMessages', 0))
+        self.in_flight = int(attributes.get('ApproximateNumberOfMessagesNotVisible', 0))
+        QUEUE_MESSAGES.labels('visible').set(self.visible)
+        QUEUE_MESSAGES.labels('in_flight').set(self.in_flight)
+        BACKLOG_PER_WORKER.set(self.visible / self.workers)
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f'Error reading the queue attributes: {e}')
+            if self.rate_meter is not None:
+                self.rate_meter.add(0)
+            time.sleep(self.interval)
+
+
+class AdaptivePoller:
+    """
+    receive_message with a wait time that follows the load. An empty receive means the queue is
+    idle: the next one long polls for `idle_wait` seconds, one request instead of many empty ones.
+    A full batch, or a partial one while the monitor still sees visible messages, means a backlog:
+    the next receive doesn't wait at all.
+    """
+
+    def __init__(self, sqs_client, queue_url, idle_wait=IDLE_WAIT, monitor=None):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.idle_wait = idle_wait
+        self.monitor = monitor
+        self.backlog = False
+
+    def wait_time(self):
+        return 0 if self.backlog else self.idle_wait
+
+    def receive(self, max_messages, wait_time=None):
+        """
+        :param wait_time: overrides the adaptive wait, e.g. to top up a batch within a deadline
+        """
+        with timed('sqs_receive'):
+            response = self.sqs_client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=max_messages,
+                WaitTimeSeconds=self.wait_time() if wait_time is None else wait_time,
+                AttributeNames=['SentTimestamp'],
+            )
+        messages = response.get('Messages', [])
+        RECEIVES.labels('messages' if messages else 'empty').inc()
+
+        if not messages:
+            self.backlog = False
+        elif len(messages) == max_messages:
+            self.backlog = True
+        else:
+            self.backlog = self.monitor is not None and self.monitor.visible > 0
+
+        sent = [int(m['Attributes']['SentTimestamp']) for m in messages if 'SentTimestamp' in m.get('Attributes', {})]
+        if sent or wait_time is None:
+            # a top-up that came back empty says nothing about the age of the batch it tops up
+            OLDEST_MESSAGE_AGE.set(max(0.0, time.time() - min(sent) / 1000) if sent else 0)
+        return messages
+
+
+class RateMeter:
+    """Images per second, an exponentially weighted moving average over the finished batches"""
+
+    def __init__(self, half_life=RATE_HALF_LIFE):
+        self.half_life = half_life
+        self.rate = 0.0
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, count):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(now - self.updated_at, 1e-3)
+            weight = math.exp(-elapsed * math.log(2) / self.half_life)
+            self.rate = weight * self.rate + (1 - weight) * count / elapsed
+            self.updated_at = now
+            PROCESSING_RATE.set(self.rate)
+            return self.rate
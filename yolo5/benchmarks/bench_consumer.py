@@ -0,0 +1,285 @@
+"""
+Load test of the yolo5 consumer, offline: S3, SQS and DynamoDB are in-memory stand-ins and the
+polybot /results callback is a local HTTP server. The real model and the real ConsumerRuntime
+(forked workers, heartbeat, batch deletes) are used.
+
+Prediction jobs are queued open loop at --rate per second, a job is done when the poller deletes
+its message. Reports p50/p95/p99 latency, throughput and peak RSS (poller and workers) and saves
+them as JSON; with --baseline the p95 is compared against an earlier run and the script exits with
+status 1 if it is slower by more than --tolerance. It also exits with status 1 if a job never
+finishes or a /results callback has no chat id. The jobs are queued with the keys polybot's
+request_prediction uses. The polybot side is covered by polybot/benchmarks/bench_load.py.
+
+Run from the directory the worker runs in (the yolov5 checkout with yolov5s.pt), the worker
+settings come from the usual environment variables (WORKERS, BATCH_SIZE, BATCH_MAX_WAIT):
+    python benchmarks/bench_consumer.py [--requests 100] [--rate 5] [--image street.jpg] [--output consumer.json]
+"""
+import argparse
+import json
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BUCKET = 'bench-bucket'
+QUEUE_URL = 'bench-queue'
+
+
+class FakeS3:
+    """Objects put before the workers fork are visible to all of them"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.objects = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        time.sleep(self.latency)
+        self.objects[(bucket, key)] = fileobj.read()
+
+    def upload_file(self, filename, bucket, key, **kwargs):
+        time.sleep(self.latency)
+        with open(filename, 'rb') as f:
+            self.objects[(bucket, key)] = f.read()
+
+    def download_fileobj(self, bucket, key, fileobj, **kwargs):
+        time.sleep(self.latency)
+        fileobj.write(self.objects[(bucket, key)])
+
+    def download_file(self, bucket, key, filename, **kwargs):
+        time.sleep(self.latency)
+        Path(filename).write_bytes(self.objects[(bucket, key)])
+
+
+class FakeSQS:
+    """
+    Only the poller (the parent process) receives and deletes, so one in-memory queue is enough.
+    Long polls return as soon as a message arrives, waiting at most `max_long_poll` seconds.
+    """
+
+    def __init__(self, latency, max_long_poll=20):
+        self.latency = latency
+        self.max_long_poll = max_long_poll
+        self.messages = deque()
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.receives = 0
+        self.empty_receives = 0
+        self.deleted = {}  # prediction id -> deleted at
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        time.sleep(self.latency)
+        message_id = str(uuid.uuid4())
+        with self.condition:
+            self.messages.append({'MessageId': message_id, 'ReceiptHandle': MessageBody, 'Body': MessageBody,
+                                  'Attributes': {'SentTimestamp': str(int(time.time() * 1000))}})
+            self.condition.notify_all()
+        return {'MessageId': message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        time.sleep(self.latency)
+        with self.condition:
+            self.condition.wait_for(lambda: self.messages, timeout=min(WaitTimeSeconds, self.max_long_poll))
+            batch = [self.messages.popleft() for _ in range(min(MaxNumberOfMessages, len(self.messages)))]
+            self.in_flight += len(batch)
+            self.receives += 1
+            self.empty_receives += not batch
+        return {'Messages': batch} if batch else {}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        time.sleep(self.latency)
+        with self.condition:
+            return {'Attributes': {'ApproximateNumberOfMessages': str(len(self.messages)),
+                                   'ApproximateNumberOfMessagesNotVisible': str(self.in_flight)}}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        time.sleep(self.latency)
+        now = time.perf_counter()
+        with self.condition:
+            self.in_flight -= len(Entries)
+            for entry in Entries:
+                # the receipt handle is the body, which carries the prediction id
+                self.deleted[json.loads(entry['ReceiptHandle'])['prediction_id']] = now
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        time.sleep(self.latency)
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+
+class FakeDynamoDB:
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def put_item(self, TableName, Item):
+        time.sleep(self.latency)
+
+    def batch_write_item(self, RequestItems):
+        time.sleep(self.latency)
+        return {'UnprocessedItems': {}}
+
+
+def prediction_job(chat_id, prediction_id):
+    """
+    The job body as ObjectDetectionBot.request_prediction builds it: the photo is uploaded to S3
+    under the basename of imgName, which is the Telegram file path
+    """
+    return {
+        'imgName': 'photos/bench.jpg',
+        'chat_id': chat_id,
+        'prediction_id': prediction_id,
+        'content_hash': f'bench-{prediction_id}',
+        'scale': 1.0,
+        'original_width': 640,
+        'original_height': 480,
+    }
+
+
+def start_results_server():
+    """Stands in for polybot's /results, counts the callbacks"""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'Ok')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, received
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'p50': round(float(p50), 4), 'p95': round(float(p95), 4), 'p99': round(float(p99), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=5, help='jobs per second')
+    parser.add_argument('--image', help='photo to predict on, a synthetic 640x480 image by default')
+    parser.add_argument('--network-latency', type=float, default=0.02, help='seconds per stand-in call')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--output', default='consumer.json')
+    parser.add_argument('--baseline', help='results of an earlier run to compare the p95 latency against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 increase over the baseline')
+    args = parser.parse_args()
+
+    import cv2
+    if args.image:
+        photo = Path(args.image).read_bytes()
+    else:
+        rng = np.random.default_rng(0)
+        photo = cv2.imencode('.jpg', rng.integers(0, 256, (480, 640, 3), dtype=np.uint8))[1].tobytes()
+
+    # long polls are cut short so the runtime doesn't wait out a 20 s poll once every job is done
+    sqs, s3, dynamodb = FakeSQS(args.network_latency, max_long_poll=1), FakeS3(args.network_latency), FakeDynamoDB(args.network_latency)
+    s3.objects[(BUCKET, 'bench.jpg')] = photo
+    clients = {'sqs': sqs, 's3': s3, 'dynamodb': dynamodb}
+
+    import aws_clients
+    aws_clients.get_client = lambda service_name, region_name=None: clients[service_name]
+
+    server, callbacks = start_results_server()
+    os.environ.update({
+        'S3_BUCKET': BUCKET, 'SQS_QUEUE_URL': QUEUE_URL, 'DYNAMO_NAME': 'bench-table',
+        'TELEGRAM_APP_URL': f'127.0.0.1:{server.server_port}',
+    })
+
+    import app
+    from consumer import ConsumerRuntime
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    sent = {}
+
+    def produce():
+        start = time.perf_counter()
+        for i in range(args.requests):
+            # open loop: jobs arrive on schedule whether or not the consumer keeps up
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            prediction_id = str(uuid.uuid4())
+            sent[prediction_id] = time.perf_counter()
+            sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=json.dumps(prediction_job(i, prediction_id)))
+
+    def stop_when_done():
+        deadline = time.monotonic() + args.timeout
+        while len(sqs.deleted) < args.requests and time.monotonic() < deadline:
+            time.sleep(0.1)
+        # the same signal the orchestrator sends, the runtime drains and returns
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    runtime = ConsumerRuntime(
+        sqs,
+        QUEUE_URL,
+        receive_batch=app.receive_batch,
+        process_batch=app.process_batch,
+        delete_messages=app.delete_messages,
+        workers=app.WORKERS,
+        visibility_timeout=app.VISIBILITY_TIMEOUT,
+        heartbeat_interval=app.HEARTBEAT_INTERVAL,
+        worker_init=app.init_worker,
+        worker_exit=app.exit_worker,
+    )
+    started = time.perf_counter()
+    threading.Thread(target=produce, daemon=True).start()
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    runtime.run()
+    server.shutdown()
+
+    latencies = [sqs.deleted[pid] - sent_at for pid, sent_at in sent.items() if pid in sqs.deleted]
+    last = max(sqs.deleted.values(), default=started)
+    result = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {'requests': args.requests, 'rate': args.rate, 'image': args.image,
+                     'network_latency': args.network_latency, 'workers': app.WORKERS,
+                     'batch_size': app.BATCH_SIZE, 'batch_max_wait': app.BATCH_MAX_WAIT},
+        'ok': len(latencies),
+        'timed_out': args.requests - len(latencies),
+        'callbacks': len(callbacks),
+        # a callback polybot can't answer, e.g. the worker and polybot disagree on the job keys
+        'callbacks_without_chat': sum(json.loads(body).get('chat_id') is None for body in callbacks),
+        'receives': sqs.receives,
+        'empty_receives': sqs.empty_receives,
+        **percentiles(latencies),
+        'throughput': round(len(latencies) / (last - started), 3) if last > started else 0.0,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'children_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+    Path(args.output).write_text(json.dumps(result, indent=2))
+    print(json.dumps(result, indent=2))
+
+    if result['timed_out'] or result['callbacks_without_chat']:
+        sys.exit(1)
+    if args.baseline:
+        old = json.loads(Path(args.baseline).read_text())
+        if old.get('p95') and result['p95'] is not None:
+            change = result['p95'] / old['p95'] - 1
+            print(f"\np95 {result['p95']:.3f}s, baseline {old['p95']:.3f}s ({change:+.1%})")
+            if change > args.tolerance:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Polling benchmark of the yolo5 poller, offline and without the model: the SQS stand-in of
+bench_consumer.py gets an idle period, a burst and another idle period, and one consumer loop
+receives and "processes" each message in --service-time seconds.
+
+Runs the old fixed 5 s long poll and the adaptive poller of autoscale.py on the same traffic and
+reports, for each, the receive calls (empty ones are what the idle long poll saves), the pickup
+delay from send to receive and the time to drain the burst. The queue monitor runs alongside, its
+last backlog and processing rate readings are reported too.
+
+Run from the yolo5 directory:
+    python benchmarks/bench_polling.py [--idle 30] [--burst 200] [--burst-rate 50] [--output polling.json]
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+sys.path.insert(0, str(BENCH_DIR))
+
+QUEUE_URL = 'bench-queue'
+
+
+def run(mode, args):
+    import autoscale
+    from bench_consumer import FakeSQS
+
+    sqs = FakeSQS(args.network_latency)
+    rate_meter = autoscale.RateMeter(half_life=5)
+    monitor = autoscale.QueueMonitor(sqs, QUEUE_URL, workers=1, interval=1, rate_meter=rate_meter).start()
+    poller = autoscale.AdaptivePoller(sqs, QUEUE_URL, monitor=monitor)
+    if mode == 'fixed':
+        # what consume() did before: always a 5 s long poll
+        poller.wait_time = lambda: 5
+
+    sent, picked = {}, {}
+    done = threading.Event()
+
+    def produce():
+        time.sleep(args.idle)
+        start = time.perf_counter()
+        for i in range(args.burst):
+            delay = start + i / args.burst_rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sent[i] = time.perf_counter()
+            sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=json.dumps({'prediction_id': str(i)}))
+        time.sleep(args.idle)
+        done.set()
+
+    threading.Thread(target=produce, daemon=True).start()
+    readings = []
+    while not done.is_set():
+        messages = poller.receive(args.batch_size)
+        now = time.perf_counter()
+        for m in messages:
+            picked[int(json.loads(m['Body'])['prediction_id'])] = now
+        time.sleep(args.service_time * len(messages))
+        if messages:
+            sqs.delete_message_batch(QueueUrl=QUEUE_URL, Entries=[
+                {'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages)])
+            rate_meter.add(len(messages))
+            readings.append((monitor.visible / monitor.workers, rate_meter.rate))
+
+    delays = [picked[i] - sent[i] for i in sent if i in picked]
+    p50, p95 = np.percentile(delays, [50, 95]) if delays else (0, 0)
+    return {
+        'mode': mode,
+        'receives': sqs.receives,
+        'empty_receives': sqs.empty_receives,
+        'picked': len(picked),
+        'pickup_p50': round(float(p50), 4),
+        'pickup_p95': round(float(p95), 4),
+        'drain_seconds': round(max(picked.values()) - min(sent.values()), 3) if picked else None,
+        'max_backlog_per_worker': max((backlog for backlog, _ in readings), default=0),
+        'peak_images_per_second': round(max((rate for _, rate in readings), default=0.0), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--idle', type=float, default=30, help='seconds without traffic before and after the burst')
+    parser.add_argument('--burst', type=int, default=200, help='messages in the burst')
+    parser.add_argument('--burst-rate', type=float, default=50, help='messages per second during the burst')
+    parser.add_argument('--service-time', type=float, default=0.03, help='seconds to process one message')
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--network-latency', type=float, default=0.01, help='seconds per stand-in call')
+    parser.add_argument('--output', default='polling.json')
+    args = parser.parse_args()
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    results = [run(mode, args) for mode in ('fixed', 'adaptive')]
+    print(f"{'mode':>9} {'receives':>9} {'empty':>6} {'p50':>7} {'p95':>7} {'drain s':>8}")
+    for r in results:
+        print(f"{r['mode']:>9} {r['receives']:>9} {r['empty_receives']:>6} {r['pickup_p50']:>7.3f} "
+              f"{r['pickup_p95']:>7.3f} {r['drain_seconds']:>8.2f}")
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'settings': vars(args), 'results': results}
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f'\nResults saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+import multiprocessing
+import signal
+import threading
+import time
+from loguru import logger
+
+# batches handed to a worker ahead of time: the one it processes and the next one, waiting in its pipe
+BATCHES_PER_WORKER = 2
+
+
+class WorkerStats:
+
+    def __init__(self):
+        self.batches = 0
+        self.messages = 0
+        self.succeeded = 0
+        self.busy_seconds = 0.0
+
+    def to_dict(self, uptime):
+        return {
+            'batches': self.batches,
+            'messages': self.messages,
+            'succeeded': self.succeeded,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'messages_per_second': round(self.messages / uptime, 3) if uptime else 0.0,
+            'utilization': round(self.busy_seconds / uptime, 3) if uptime else 0.0,
+        }
+
+
+class ConsumerRuntime:
+    """
+    One poller feeding `workers` forked worker processes, each through its own pipe: the poller
+    picks the worker, so no worker waits on a lock that another one could die holding.
+    The parent process owns SQS: it receives, deletes succeeded messages and keeps the visibility
+    timeout of in-flight messages extended from a heartbeat thread. A worker that dies (OOM kill,
+    segfault) is replaced, its batch is no longer heartbeated and SQS redelivers it. On SIGTERM it
+    stops receiving, lets the workers finish whatever was already handed to them and exits.
+    """
+
+    def __init__(self, sqs_client, queue_url, receive_batch, process_batch, delete_messages, workers=1,
+                 visibility_timeout=60, heartbeat_interval=20, max_processing_time=900,
+                 worker_init=None, worker_exit=None, stats_interval=60, on_processed=None, on_worker_died=None):
+        """
+        :param receive_batch: () -> list of SQS messages
+        :param process_batch: (messages) -> the messages that succeeded, runs in the worker processes
+        :param delete_messages: (messages) -> None, deletes messages from the queue
+        :param max_processing_time: seconds after which a message stops being heartbeated, so a stuck
+                                    or crashed worker can't hold it forever
+        :param worker_init: (worker_id) -> None, called in each worker process after fork
+        :param worker_exit: (worker_id) -> None, called in each worker process before it exits
+        :param on_processed: (messages, succeeded) -> None, called in the poller process after each batch
+        :param on_worker_died: (worker_id, pid) -> None, called in the poller process when a worker died
+                               without running worker_exit
+        """
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.receive_batch = receive_batch
+        self.process_batch = process_batch
+        self.delete_messages = delete_messages
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.max_processing_time = max_processing_time
+        self.worker_init = worker_init
+        self.worker_exit = worker_exit
+        self.on_processed = on_processed
+        self.on_worker_died = on_worker_died
+        self.stats_interval = stats_interval
+
+        # fork so the workers inherit the already loaded and warmed up model
+        self.ctx = multiprocessing.get_context('fork')
+        self.task_pipes = {}  # worker id -> the sending end of its task pipe
+        # puts are written to the pipe right away, not by a feeder thread that a killed worker would take down
+        # with whatever it hadn't sent yet
+        self.results = self.ctx.SimpleQueue()
+
+        self.lock = threading.Lock()
+        self.in_flight = {}  # MessageId -> (ReceiptHandle, received at)
+        self.assigned = {}  # worker id -> MessageIds of each batch sent to it and not done yet
+        self.processes = {}  # worker id -> its current process
+        self.running = 0  # processes whose exit _collect_results hasn't seen yet
+        self.stopping = threading.Event()
+        self.batch_done = threading.Event()
+        self.stats = {worker_id: WorkerStats() for worker_id in range(workers)}
+        self.started_at = time.monotonic()
+
+    def stop(self, signum=None, frame=None):
+        logger.info('Stop requested, draining in-flight messages')
+        self.stopping.set()
+
+    def stats_snapshot(self):
+        uptime = time.monotonic() - self.started_at
+        with self.lock:
+            return {
+                'in_flight': len(self.in_flight),
+                'workers': {worker_id: stats.to_dict(uptime) for worker_id, stats in self.stats.items()},
+            }
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.running = self.workers
+        for worker_id in range(self.workers):
+            self._start_worker(worker_id)
+
+        result_thread = threading.Thread(target=self._collect_results, name='results')
+        result_thread.start()
+        threading.Thread(target=self._heartbeat, name='heartbeat', daemon=True).start()
+        threading.Thread(target=self._report_stats, name='stats', daemon=True).start()
+
+        logger.info(f'Consumer started with {self.workers} workers')
+        while not self.stopping.is_set():
+            # only receive what a worker can take, which is the backpressure on the poller
+            if self._wait_for_worker(until_stopping=True) is None:
+                break
+            try:
+                messages = self.receive_batch()
+            except Exception as e:
+                logger.error(f'Error receiving messages: {e}')
+                time.sleep(1)
+                continue
+
+            if messages:
+                now = time.monotonic()
+                with self.lock:
+                    for m in messages:
+                        self.in_flight[m['MessageId']] = (m['ReceiptHandle'], now)
+                self._dispatch(messages)
+
+        for worker_id, pipe in list(self.task_pipes.items()):
+            try:
+                pipe.send(None)
+            except OSError:
+                pass  # died, reported below
+        for worker_id, process in list(self.processes.items()):
+            while process.exitcode is None:
+                process.join(1)
+                self._check_workers(respawn=False)
+        self._check_workers(respawn=False)
+        result_thread.join()
+        logger.info(f'Consumer stopped, stats: {self.stats_snapshot()}')
+
+    def _start_worker(self, worker_id):
+        reader, writer = self.ctx.Pipe(duplex=False)
+        process = self.ctx.Process(target=self._worker_main, args=(worker_id, reader), daemon=True)
+        self.processes[worker_id] = process
+        self.task_pipes[worker_id] = writer
+        with self.lock:
+            self.assigned[worker_id] = []
+        process.start()
+        # the worker holds the only reading end, sending to it once it died raises instead of blocking
+        reader.close()
+
+    def _check_workers(self, respawn=True):
+        """
+        Reports the workers that died to _collect_results and, with `respawn`, replaces them.
+        Until the stop markers go out (`respawn`) a worker never exits on its own, afterwards only
+        a non-zero exit code means it died.
+        """
+        for worker_id, process in list(self.processes.items()):
+            if process.exitcode is None or (not respawn and process.exitcode == 0):
+                continue
+
+            logger.error(f'Worker {worker_id} (pid {process.pid}) died with exit code {process.exitcode}')
+            del self.processes[worker_id]
+            self.task_pipes.pop(worker_id).close()
+            if self.on_worker_died is not None:
+                self.on_worker_died(worker_id, process.pid)
+            with self.lock:
+                batches = self.assigned.pop(worker_id, [])
+                if respawn:
+                    # counted before the death, so the running count can't reach 0 in between
+                    self.running += 1
+            # its batches are left to the visibility timeout, SQS redelivers them
+            self.results.put(('died', worker_id, [message_id for batch in batches for message_id in batch]))
+            if respawn:
+                self._start_worker(worker_id)
+
+    def _wait_for_worker(self, until_stopping=False):
+        """
+        The worker with the fewest batches, once one has room for another, watching the workers meanwhile.
+        None if `until_stopping` and a stop was requested first
+        """
+        while True:
+            self.batch_done.clear()
+            self._check_workers()
+            with self.lock:
+                worker_id = min(self.processes, key=lambda w: len(self.assigned[w]))
+                if len(self.assigned[worker_id]) < BATCHES_PER_WORKER:
+                    return worker_id
+            if until_stopping and self.stopping.is_set():
+                return None
+            self.batch_done.wait(1)
+
+    def _dispatch(self, messages):
+        message_ids = [m['MessageId'] for m in messages]
+        while True:
+            worker_id = self._wait_for_worker()
+            with self.lock:
+                self.assigned[worker_id].append(message_ids)
+            try:
+                self.task_pipes[worker_id].send(messages)
+                return
+            except OSError as e:
+                logger.error(f'Worker {worker_id}: could not send it a batch: {e}')
+                with self.lock:
+                    if message_ids in self.assigned.get(worker_id, []):
+                        self.assigned[worker_id].remove(message_ids)
+                # it is dying, wait for its exit code so _check_workers replaces it
+                self.processes[worker_id].join(1)
+
+    def _worker_main(self, worker_id, tasks):
+        # only the parent reacts to signals, workers exit once their pipe hands them the stop marker
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.worker_init is not None:
+            self.worker_init(worker_id)
+
+        while True:
+            messages = tasks.recv()
+            if messages is None:
+                break
+
+            started_at = time.monotonic()
+            try:
+                succeeded = self.process_batch(messages)
+            except Exception as e:
+                logger.error(f'Worker {worker_id}: error processing batch: {e}')
+                succeeded = []
+            self.results.put(('done', worker_id, messages, succeeded, time.monotonic() - started_at))
+
+        if self.worker_exit is not None:
+            try:
+                self.worker_exit(worker_id)
+            except Exception as e:
+                # still a clean exit: the stop marker was taken, a non-zero exit code would count it twice
+                logger.error(f'Worker {worker_id}: error exiting: {e}')
+        self.results.put(('exited', worker_id))
+
+    def _collect_results(self):
+        while True:
+            kind, worker_id, *payload = self.results.get()
+            if kind in ('exited', 'died'):
+                with self.lock:
+                    for message_id in payload[0] if kind == 'died' else []:
+                        self.in_flight.pop(message_id, None)
+                    self.running -= 1
+                    if not self.running:
+                        break
+                self.batch_done.set()
+                continue
+
+            messages, succeeded, elapsed = payload
+
+            try:
+                self.delete_messages(succeeded)
+            except Exception as e:
+                logger.error(f'Error deleting messages: {e}')
+
+            # failed messages are no longer heartbeated, SQS makes them visible again after the timeout
+            with self.lock:
+                for m in messages:
+                    self.in_flight.pop(m['MessageId'], None)
+                # a dead worker's batches were already taken off, the replacement's must stay
+                batch = [m['MessageId'] for m in messages]
+                if batch in self.assigned.get(worker_id, []):
+                    self.assigned[worker_id].remove(batch)
+                stats = self.stats[worker_id]
+                stats.batches += 1
+                stats.messages += len(messages)
+                stats.succeeded += len(succeeded)
+                stats.busy_seconds += elapsed
+            self.batch_done.set()
+
+            if self.on_processed is not None:
+                self.on_processed(messages, succeeded)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            with self.lock:
+                receipts = [receipt for receipt, received_at in self.in_flight.values()
+                            if now - received_at < self.max_processing_time]
+
+            for start in range(0, len(receipts), 10):
+                entries = [{'Id': str(i), 'ReceiptHandle': receipt, 'VisibilityTimeout': self.visibility_timeout}
+                           for i, receipt in enumerate(receipts[start:start + 10])]
+                try:
+                    self.sqs_client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+                except Exception as e:
+                    logger.error(f'Error extending message visibility: {e}')
+
+    def _report_stats(self):
+        while not self.stopping.wait(self.stats_interval):
+            logger.info(f'Consumer stats: {self.stats_snapshot()}')
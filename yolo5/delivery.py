@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from metrics import timed
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, then lets a single trial call through
+    every `reset_timeout` seconds until one succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # half open: the next failure re-opens it for another full timeout
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f'Circuit opened after {self.failures} consecutive failures')
+                self.opened_at = time.monotonic()
+
+
+class ResultDelivery:
+    """
+    Pushes prediction results to polybot in the background.
+    Posts go through a pooled keep-alive session, are retried with exponential backoff and
+    guarded by a circuit breaker. Whatever can't be posted goes to the results queue, which
+    polybot drains on its own.
+    """
+
+    def __init__(self, results_url, sqs_client=None, results_queue_url=None, max_workers=4,
+                 retries=3, backoff=0.5, timeout=5, breaker=None):
+        self.results_url = results_url
+        self.sqs_client = sqs_client
+        self.results_queue_url = results_queue_url
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='delivery')
+
+    def deliver(self, payload):
+        """Queues the payload for delivery and returns right away"""
+        return self.executor.submit(self._deliver, payload)
+
+    def _deliver(self, payload):
+        with logger.contextualize(trace_id=payload.get('traceId') or '-'):
+            return self._post(payload)
+
+    def _post(self, payload):
+        if self.breaker.allow():
+            for attempt in range(self.retries):
+                try:
+                    with timed('results_callback'):
+                        response = self.session.post(self.results_url, json=payload, timeout=self.timeout)
+                        response.raise_for_status()
+                    self.breaker.record_success()
+                    return True
+                except requests.RequestException as e:
+                    logger.warning(f'Prediction: {payload["predictionId"]}. Result delivery attempt {attempt + 1} failed: {e}')
+                    if attempt + 1 < self.retries:
+                        time.sleep(self.backoff * 2 ** attempt)
+            self.breaker.record_failure()
+
+        return self._fallback(payload)
+
+    def _fallback(self, payload):
+        if self.results_queue_url is None:
+            logger.error(f'Prediction: {payload["predictionId"]}. Result could not be delivered')
+            return False
+
+        try:
+            self.sqs_client.send_message(QueueUrl=self.results_queue_url, MessageBody=json.dumps(payload))
+            logger.info(f'Prediction: {payload["predictionId"]}. Result sent to the results queue')
+            return True
+        except Exception as e:
+            logger.error(f'Prediction: {payload["predictionId"]}. Result could not be queued: {e}')
+            return False
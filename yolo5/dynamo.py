@@ -0,0 +1,148 @@
+import itertools
+import math
+import random
+import threading
+import time
+from decimal import Decimal
+from loguru import logger
+from metrics import timed, ERRORS
+
+# batch_write_item takes at most 25 put requests
+MAX_BATCH_ITEMS = 25
+
+
+def _number(value):
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError(f'DynamoDB can\'t store {value}')
+    return {'N': repr(float(value)) if isinstance(value, float) else str(value)}
+
+
+# exact type -> serializer, looked up once per value instead of walking an isinstance chain
+_SERIALIZERS = {
+    str: lambda value: {'S': value},
+    bool: lambda value: {'BOOL': value},
+    int: _number,
+    float: _number,
+    Decimal: _number,
+    bytes: lambda value: {'B': value},
+    type(None): lambda value: {'NULL': True},
+    dict: lambda value: {'M': {k: serialize(v) for k, v in value.items()}},
+    list: lambda value: {'L': [serialize(v) for v in value]},
+    tuple: lambda value: {'L': [serialize(v) for v in value]},
+}
+
+
+def serialize(value):
+    """Python value -> DynamoDB attribute value, numbers stay numbers and empty lists are fine"""
+    serializer = _SERIALIZERS.get(type(value))
+    if serializer is None:
+        for base, candidate in _SERIALIZERS.items():
+            if isinstance(value, base):
+                serializer = _SERIALIZERS[type(value)] = candidate
+                break
+        else:
+            raise TypeError(f'Unsupported type for DynamoDB: {type(value).__name__}')
+    return serializer(value)
+
+
+def to_item(summary):
+    """Prediction summary -> DynamoDB item, None values are left out"""
+    return {key: serialize(value) for key, value in summary.items() if value is not None}
+
+
+class WriteBehindBuffer:
+    """
+    Collects items and writes them with batch_write_item from a background thread, up to 25 at a
+    time. Pending items with the same `key` are merged, the last one wins: SQS delivers at least
+    once, and batch_write_item rejects a batch holding the same key twice. A batch goes out when it
+    is full or `flush_interval` seconds after its first item, unprocessed items are retried with
+    jittered exponential backoff, the items of a rejected batch one at a time. `put` blocks while
+    `max_pending` items are waiting, so a throttled table slows the producer instead of growing
+    the buffer.
+    """
+
+    def __init__(self, client, table_name, flush_interval=1.0, max_pending=1000, retries=5, backoff=0.05,
+                 key='prediction_id'):
+        """:param key: the hash key attribute of the table"""
+        self.client = client
+        self.table_name = table_name
+        self.key = key
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retries = retries
+        self.backoff = backoff
+
+        self.pending = {}  # key value -> item, in the order the keys were first put
+        self.first_put_at = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='dynamodb-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        key = tuple(item[self.key].items())
+        with self.condition:
+            while len(self.pending) >= self.max_pending and key not in self.pending and not self.closed:
+                self.condition.wait()
+            if self.first_put_at is None:
+                self.first_put_at = time.monotonic()
+            self.pending[key] = item
+            self.condition.notify_all()
+
+    def close(self):
+        """Writes whatever is still pending and stops the writer thread"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _next_batch(self):
+        """Waits for a full batch, the flush interval or close(), returns [] once closed and empty"""
+        with self.condition:
+            while True:
+                if len(self.pending) >= MAX_BATCH_ITEMS or (self.closed and self.pending):
+                    break
+                if self.closed:
+                    return []
+                if self.first_put_at is None:
+                    self.condition.wait()
+                    continue
+                remaining = self.first_put_at + self.flush_interval - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = [self.pending.pop(key) for key in list(itertools.islice(self.pending, MAX_BATCH_ITEMS))]
+            self.first_put_at = time.monotonic() if self.pending else None
+            self.condition.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self._write(batch)
+            except Exception as e:
+                logger.error(f'Error writing {len(batch)} summaries, writing them one at a time: {e}')
+                for item in batch if len(batch) > 1 else []:
+                    try:
+                        self._write([item])
+                    except Exception as e:
+                        logger.error(f'Error writing summary {item.get(self.key)}: {e}')
+
+    def _write(self, batch):
+        requests = {self.table_name: [{'PutRequest': {'Item': item}} for item in batch]}
+        for attempt in range(self.retries + 1):
+            with timed('dynamodb_put'):
+                response = self.client.batch_write_item(RequestItems=requests)
+            requests = response.get('UnprocessedItems') or {}
+            if not requests:
+                return
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+        dropped = sum(len(r) for r in requests.values())
+        ERRORS.labels('dynamodb_put').inc()
+        logger.error(f'{dropped} summaries still unprocessed after {self.retries} retries, dropped')
@@ -0,0 +1,67 @@
+import glob
+import os
+import time
+from contextlib import contextmanager
+
+# the forked workers record into files under PROMETHEUS_MULTIPROC_DIR, the parent serves the sum of all of them.
+# prometheus_client picks its storage when it is imported, so the default has to be in place before that
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/yolo5-metrics')
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server, multiprocess  # noqa: E402
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+
+# stages: sqs_receive, s3_download, inference, s3_upload, dynamodb_put, results_callback
+STAGE_SECONDS = Histogram(
+    'yolo5_stage_seconds', 'Time spent in each stage of a prediction', ['stage'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60),
+)
+ERRORS = Counter('yolo5_errors_total', 'Errors by stage', ['stage'])
+MESSAGES = Counter('yolo5_messages_total', 'Messages processed by the workers, by result', ['result'])
+
+# the autoscaling signal, set by the poller process only (livesum drops the series of a dead poller)
+QUEUE_MESSAGES = Gauge('yolo5_queue_messages', 'Approximate number of messages by state', ['state'],
+                       multiprocess_mode='livesum')
+BACKLOG_PER_WORKER = Gauge('yolo5_backlog_per_worker', 'Visible messages per worker process of this pod',
+                           multiprocess_mode='livesum')
+OLDEST_MESSAGE_AGE = Gauge('yolo5_oldest_message_age_seconds', 'Age of the oldest message of the last receive',
+                           multiprocess_mode='livesum')
+PROCESSING_RATE = Gauge('yolo5_images_per_second', 'Images processed per second by this pod, moving average',
+                        multiprocess_mode='livesum')
+RECEIVES = Counter('yolo5_sqs_receives_total', 'receive_message calls, by whether they returned messages', ['result'])
+
+
+@contextmanager
+def timed(stage):
+    """Records the duration of the block in STAGE_SECONDS, and in ERRORS if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def clear_stale_metrics():
+    """
+    Removes the files left by earlier runs (every file is named after the pid that writes it),
+    keeping this process' own. Call it in the poller before the workers are forked.
+    """
+    for path in glob.glob(os.path.join(PROMETHEUS_MULTIPROC_DIR, '*.db')):
+        if not path.endswith(f'_{os.getpid()}.db'):
+            os.remove(path)
+
+
+def mark_process_dead(pid):
+    """Drops the live gauges of a worker that exited, its counters and histograms keep counting in the totals"""
+    multiprocess.mark_process_dead(pid, PROMETHEUS_MULTIPROC_DIR)
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serves /metrics on `port`, aggregated over every worker process"""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
@@ -0,0 +1,91 @@
+import numpy as np
+import torch
+from loguru import logger
+from detections import Detections
+
+# yolov5 internals, available in the ultralytics/yolov5 image this service is built on
+from models.common import DetectMultiBackend
+from utils.augmentations import letterbox
+from utils.general import check_img_size, non_max_suppression, scale_boxes
+from utils.plots import Annotator, colors
+from utils.torch_utils import select_device
+
+
+class Predictor:
+    """
+    Loads the YOLOv5 model once and keeps it resident, so each image only pays for inference.
+    Images are HxWx3 uint8 BGR arrays (cv2 convention, same as detect.py).
+    """
+
+    def __init__(self, weights='yolov5s.pt', data='data/coco128.yaml', imgsz=640, conf_thres=0.25,
+                 iou_thres=0.45, max_det=1000, device='', model=None):
+        """
+        :param model: an already constructed model, e.g. a tiny stand-in in tests.
+                      When given, `weights` and `data` are ignored.
+        """
+        self.device = select_device(device)
+        self.model = model if model is not None else DetectMultiBackend(weights, device=self.device, data=data)
+        self.stride = int(self.model.stride)
+        self.names = self.model.names
+        self.imgsz = check_img_size((imgsz, imgsz), s=self.stride)
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_det = max_det
+
+        self.warmup()
+        logger.info(f'Model loaded and warmed up, {len(self.names)} classes, image size {self.imgsz}')
+
+    def warmup(self):
+        """
+        Runs one blank image through detect() so the first real request doesn't pay for lazy initialization.
+        DetectMultiBackend.warmup skips the CPU, which is what this service runs on
+        """
+        self.detect(np.zeros((*self.imgsz, 3), np.uint8))
+
+    def preprocess(self, image, auto=True):
+        # auto=False pads every image to the full square size, so a batch can be stacked
+        im = letterbox(image, self.imgsz, stride=self.stride, auto=auto and self.model.pt)[0]
+        im = np.ascontiguousarray(im.transpose((2, 0, 1))[::-1])  # HWC to CHW, BGR to RGB
+        im = torch.from_numpy(im).to(self.model.device)
+        im = im.half() if self.model.fp16 else im.float()
+        return (im / 255)[None]
+
+    @torch.no_grad()
+    def detect(self, image):
+        """
+        :return: (n, 6) tensor of x1, y1, x2, y2, confidence, class id in `image` pixel coordinates
+        """
+        im = self.preprocess(image)
+        pred = self.model(im)
+        det = non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)[0]
+        det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], image.shape).round()
+        return det
+
+    @torch.no_grad()
+    def detect_batch(self, images):
+        """Runs a micro-batch of images through the model in one forward pass, returns one detect() result per image"""
+        if len(images) == 1:
+            return [self.detect(images[0])]
+
+        batch = torch.cat([self.preprocess(image, auto=False) for image in images])
+        pred = self.model(batch)
+        dets = non_max_suppression(pred, self.conf_thres, self.iou_thres, max_det=self.max_det)
+        for det, image in zip(dets, images):
+            det[:, :4] = scale_boxes(batch.shape[2:], det[:, :4], image.shape).round()
+        return dets
+
+    def to_detections(self, det, image_shape):
+        """Wraps the model output of one image, see Detections.from_model"""
+        return Detections.from_model(det, image_shape, self.names)
+
+    def annotate(self, image, det):
+        """Returns a copy of `image` with the detections drawn on it"""
+        annotator = Annotator(image.copy(), line_width=3, example=str(self.names))
+        for *xyxy, conf, cls in reversed(det):
+            c = int(cls)
+            annotator.box_label(xyxy, f'{self.names[c]} {conf:.2f}', color=colors(c, True))
+        return annotator.result()
+
+    def predict(self, image):
+        """Runs inference on a single image and returns its Detections"""
+        return self.to_detections(self.detect(image), image.shape)
@@ -0,0 +1,162 @@
+import importlib
+import json
+import sys
+import types
+from concurrent.futures import Future
+from io import BytesIO
+
+import boto3
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('torch')
+moto = pytest.importorskip('moto')
+
+from detections import Detections  # noqa: E402
+
+BUCKET = 'yolo5-test-images'
+REGION = 'us-west-1'
+
+
+class StubPredictor:
+    """Finds one "person" in every image, without a model"""
+
+    names = ['person']
+
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+
+    def detect_batch(self, images):
+        self.batches.append(len(images))
+        return [np.array([[10, 10, 50, 60, 0.9, 0]], dtype=np.float32) for _ in images]
+
+    def to_detections(self, det, image_shape):
+        return Detections.from_model(det, image_shape, self.names)
+
+    def annotate(self, image, det):
+        return image.copy()
+
+
+class StubDelivery:
+    """Resolves right away: delivered unless the chat is in `failing`"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.payloads = []
+
+    def deliver(self, payload):
+        self.payloads.append(payload)
+        future = Future()
+        future.set_result(payload['chat_id'] not in self.failing)
+        return future
+
+
+@pytest.fixture
+def app(monkeypatch):
+    for key, value in {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+                       'AWS_DEFAULT_REGION': REGION}.items():
+        monkeypatch.setenv(key, value)
+
+    with moto.mock_aws():
+        s3 = boto3.client('s3', region_name=REGION)
+        s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': REGION})
+        queue_url = boto3.client('sqs', region_name=REGION).create_queue(QueueName='yolo5-jobs')['QueueUrl']
+        boto3.client('dynamodb', region_name=REGION).create_table(
+            TableName='predictions',
+            KeySchema=[{'AttributeName': 'prediction_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'prediction_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        monkeypatch.setenv('S3_BUCKET', BUCKET)
+        monkeypatch.setenv('SQS_QUEUE_URL', queue_url)
+        monkeypatch.setenv('DYNAMO_NAME', 'predictions')
+        monkeypatch.setenv('TELEGRAM_APP_URL', 'polybot.test')
+
+        # app loads the model at import, the stub stands in for the whole predictor module
+        monkeypatch.setitem(sys.modules, 'predictor', types.SimpleNamespace(Predictor=StubPredictor))
+        monkeypatch.delitem(sys.modules, 'app', raising=False)
+        module = importlib.import_module('app')
+        yield module
+        module.summary_writer.close()
+        sys.modules.pop('app', None)
+
+
+def upload_photo(app, name):
+    ok, encoded = cv2.imencode('.jpg', np.full((120, 160, 3), 128, np.uint8))
+    assert ok
+    app.s3_client.upload_fileobj(BytesIO(encoded.tobytes()), BUCKET, name)
+
+
+def send_job(app, chat_id, img_name):
+    body = {'imgName': f'photos/{img_name}', 'chat_id': chat_id, 'prediction_id': f'trace-{chat_id}'}
+    app.sqs_client.send_message(QueueUrl=app.SQS_QUEUE_URL, MessageBody=json.dumps(body))
+
+
+def receive_all(app, visibility_timeout):
+    response = app.sqs_client.receive_message(QueueUrl=app.SQS_QUEUE_URL, MaxNumberOfMessages=10,
+                                              VisibilityTimeout=visibility_timeout)
+    return response.get('Messages', [])
+
+
+def remaining_chats(app):
+    return sorted(json.loads(m['Body'])['chat_id'] for m in receive_all(app, visibility_timeout=30))
+
+
+def test_only_delivered_messages_are_deleted(app, monkeypatch):
+    delivery = StubDelivery(failing={2})
+    monkeypatch.setattr(app, 'delivery', delivery)
+    for chat_id in (1, 2, 3):
+        upload_photo(app, f'{chat_id}.jpg')
+        send_job(app, chat_id, f'{chat_id}.jpg')
+
+    # visible again right away, so what is left in the queue can be read back
+    messages = receive_all(app, visibility_timeout=0)
+    assert len(messages) == 3
+
+    succeeded = app.process_batch(messages)
+    app.delete_messages(succeeded)
+
+    assert sorted(json.loads(m['Body'])['chat_id'] for m in succeeded) == [1, 3]
+    assert sorted(p['chat_id'] for p in delivery.payloads) == [1, 2, 3]
+    assert remaining_chats(app) == [2]
+
+
+def test_failed_download_drops_only_its_own_message(app, monkeypatch):
+    monkeypatch.setattr(app, 'delivery', StubDelivery())
+    upload_photo(app, '1.jpg')
+    upload_photo(app, '3.jpg')
+    for chat_id in (1, 2, 3):
+        # 2.jpg was never uploaded
+        send_job(app, chat_id, f'{chat_id}.jpg')
+
+    messages = receive_all(app, visibility_timeout=0)
+    succeeded = app.process_batch(messages)
+    app.delete_messages(succeeded)
+
+    assert sorted(json.loads(m['Body'])['chat_id'] for m in succeeded) == [1, 3]
+    assert app.predictor.batches == [2]
+    assert remaining_chats(app) == [2]
+
+
+class StubPoller:
+    """Hands out `batches` in order, then nothing, recording the wait of every receive"""
+
+    def __init__(self, *batches):
+        self.batches = list(batches)
+        self.waits = []
+
+    def receive(self, max_messages, wait_time=None):
+        self.waits.append(wait_time)
+        return self.batches.pop(0) if self.batches else []
+
+
+def test_partial_batch_is_topped_up_with_one_long_poll(app, monkeypatch):
+    poller = StubPoller([{'MessageId': '1'}])
+    monkeypatch.setattr(app, 'poller', poller)
+
+    messages = app.receive_batch(batch_size=4, max_wait=0.5)
+
+    assert [m['MessageId'] for m in messages] == ['1']
+    # the adaptive wait, then a single top-up long polling for at least 1 s
+    assert poller.waits == [None, 1]
@@ -0,0 +1,66 @@
+import boto3
+import pytest
+
+moto = pytest.importorskip('moto')
+
+import dynamo  # noqa: E402
+
+REGION = 'us-west-1'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        client = boto3.client('dynamodb', region_name=REGION)
+        client.create_table(
+            TableName='predictions',
+            KeySchema=[{'AttributeName': 'prediction_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'prediction_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        yield client
+
+
+def summary(prediction_id, chat_id):
+    return dynamo.to_item({'prediction_id': prediction_id, 'chat_id': chat_id})
+
+
+def stored(client):
+    items = client.scan(TableName='predictions')['Items']
+    return {item['prediction_id']['S']: int(item['chat_id']['N']) for item in items}
+
+
+def test_redelivered_summaries_are_merged(client):
+    buffer = dynamo.WriteBehindBuffer(client, 'predictions', flush_interval=60)
+    buffer.put(summary('a', 1))
+    buffer.put(summary('b', 2))
+    buffer.put(summary('a', 3))
+    assert len(buffer.pending) == 2
+    buffer.close()
+    assert stored(client) == {'a': 3, 'b': 2}
+
+
+class RejectingBatches:
+    """Rejects every batch of more than one item, as DynamoDB does a batch with a duplicate key"""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def batch_write_item(self, RequestItems):
+        self.calls.append(sum(len(r) for r in RequestItems.values()))
+        if self.calls[-1] > 1:
+            raise RuntimeError('ValidationException')
+        return self.client.batch_write_item(RequestItems=RequestItems)
+
+
+def test_rejected_batch_is_retried_item_by_item(client):
+    rejecting = RejectingBatches(client)
+    buffer = dynamo.WriteBehindBuffer(rejecting, 'predictions', flush_interval=60)
+    for i in range(3):
+        buffer.put(summary(str(i), i))
+    buffer.close()
+    assert rejecting.calls == [3, 1, 1, 1]
+    assert stored(client) == {'0': 0, '1': 1, '2': 2}
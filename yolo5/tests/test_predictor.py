@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('models.common', reason='needs the yolov5 sources, as in the service image')
+
+from predictor import Predictor  # noqa: E402
+
+
+class StubModel:
+    """Stands in for DetectMultiBackend: no weights, every box below the confidence threshold"""
+
+    stride = 32
+    names = {0: 'person', 1: 'dog'}
+    pt = False
+    fp16 = False
+    device = torch.device('cpu')
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, im):
+        self.calls.append(tuple(im.shape))
+        return torch.zeros((im.shape[0], 10, 5 + len(self.names)))
+
+
+def test_warmup_runs_an_inference_on_cpu():
+    model = StubModel()
+    Predictor(imgsz=320, device='cpu', model=model)
+    assert model.calls == [(1, 3, 320, 320)]
+
+
+def test_predict_after_warmup():
+    model = StubModel()
+    predictor = Predictor(imgsz=320, device='cpu', model=model)
+    predictor.predict(np.zeros((240, 320, 3), np.uint8))
+    assert len(model.calls) == 2